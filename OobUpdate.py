@@ -3,26 +3,80 @@
 # Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
 
 import argparse
+import atexit
+import collections
+import functools
 import os
 import sys
-import random
-import string
-import shutil
 import time
 import re
 import json
+import logging
 import signal
+import stat
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/src')
-import bf_dpu_update
 
 import subprocess
 import hashlib
+import mmap
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Status lines: one write per line under the handler lock, so lines of BMCs
+# updated in parallel do not interleave
+log = logging.getLogger('OobUpdate')
+log.setLevel(logging.INFO)
+log.propagate = False
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(logging.Formatter('%(message)s'))
+log.addHandler(_log_handler)
 
 # Version of this script tool
 Version = '25.04-2.5.7'
-task_dir = None
+# Task directories of the run_update() calls of this process, removed at exit
+# (the calls with -d or --keep-temp do not add theirs)
+task_dirs = []
 debug = False
-
+# Directory under the user's cache directory ($XDG_CACHE_HOME) keeping merged bfb
+# files for reuse across runs; they hold the cfg file, so it is never shared
+BFB_CACHE_DIR_NAME = 'OobUpdate_bfb_cache'
+# Name of the SSH master sockets to BMCs (hash of host/port/user, short enough for
+# a unix socket path), created in a private directory of each run_update() call
+SSH_MUX_CONTROL_NAME = '%C'
+# Size of the blocks written by the merge_files() fallback path
+MERGE_CHUNK_SIZE = 16 << 20
+# Task directories and cached merged files untouched for longer than this are
+# left over by killed runs, they are removed at start
+STALE_TEMP_SECONDS = 24 * 60 * 60
+# Names of the task directories (task_<task id>_<random suffix>) and of the cached
+# merged files (see merge_files()), the only entries removed as stale
+TASK_DIR_RE       = re.compile(r'^task_.+_[0-9a-f]{5}$')
+BFB_CACHE_FILE_RE = re.compile(r'^([0-9a-f]{32}\.bfb|tmp\w+\.tmp)$')
+# File marking a task directory kept on purpose (-d, --keep-temp), never removed as stale
+KEEP_TEMP_MARKER = '.keep'
+# Default upper bound of BMCs updated at the same time when -H lists several hosts (--parallel)
+MAX_PARALLEL_BMC = 32
+
+# Choices of -T and --bios_update_protocol
+MODULE_CHOICES        = tuple(sys.intern(m) for m in ('BMC', 'CEC', 'BIOS', 'FRU', 'CONFIG', 'BUNDLE'))
+BIOS_PROTOCOL_CHOICES = tuple(sys.intern(p) for p in ('HTTP', 'SCP'))
+
+# Settings of one update run and their defaults. main() builds an UpdateCfg from the
+# command line, batch drivers build it directly and call run_update(), skipping argparse
+UPDATE_CFG_DEFAULTS = (
+    ('username', None), ('password', None), ('ssh_username', None), ('ssh_password', None),
+    ('fw_file_path', None), ('module', None), ('with_config', False), ('bmc_ip', None),
+    ('clear_config', False), ('output_file', None), ('bmc_port', None),
+    ('bios_update_protocol', None), ('config_file', None), ('bfcfg', None), ('oem_fru', None),
+    ('skip_same_version', False), ('show_all_versions', False), ('debug', False),
+    ('config_path', '/tmp'), ('task_id', None), ('lfwp', False), ('keep_temp', False),
+    ('parallel', MAX_PARALLEL_BMC),
+)
+UpdateCfg = collections.namedtuple('UpdateCfg', [name for name, _ in UPDATE_CFG_DEFAULTS],
+                                   defaults=[value for _, value in UPDATE_CFG_DEFAULTS])
+
+# The parser is built once and reused, main() may be called many times in-process
+@functools.lru_cache(maxsize=1)
 def get_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-U',             metavar="<username>",        dest="username",     type=str, required=False, help='Username of BMC')
@@ -30,13 +84,13 @@ def get_arg_parser():
     parser.add_argument('-S',             metavar="<ssh_username>",    dest="ssh_username",     type=str, required=False, help='Username of BMC SSH access')
     parser.add_argument('-K',             metavar="<ssh_password>",    dest="ssh_password",     type=str, required=False, help='SSH password of BMC')
     parser.add_argument('-F',             metavar="<firmware_file>",   dest="fw_file_path", type=str, required=False, help='Firmware file path (absolute/relative)')
-    parser.add_argument('-T',             metavar="<module>",          dest="module",       type=str, required=False, help='The module to be updated: BMC|CEC|BIOS|FRU|CONFIG|BUNDLE', choices=('BMC', 'CEC', 'BIOS', 'FRU', 'CONFIG', 'BUNDLE'))
+    parser.add_argument('-T',             metavar="<module>",          dest="module",       type=str, required=False, help='The module to be updated: BMC|CEC|BIOS|FRU|CONFIG|BUNDLE', choices=MODULE_CHOICES)
     parser.add_argument('--with-config',  action='store_true',         dest="with_config",            required=False, help='Update the configuration image file during the BUNDLE update process. Do not use –lfwp together with this option.', default=False)
-    parser.add_argument('-H',             metavar="<bmc_ip>",          dest="bmc_ip",       type=str, required=False, help='IP/Host of BMC')
+    parser.add_argument('-H',             metavar="<bmc_ip>",          dest="bmc_ip",       type=str, required=False, help='IP/Host of BMC, or a comma-separated list of BMCs to update in parallel')
     parser.add_argument('-C',             action='store_true',         dest="clear_config",           required=False, help='Reset to factory configuration (Only used for BMC|BIOS)')
     parser.add_argument('-o', '--output', metavar="<output_log_file>", dest="output_file",  type=str, required=False, help='Output log file')
     parser.add_argument('-p', '--port',   metavar="<bmc_port>",        dest="bmc_port",     type=str, required=False, help='Port of BMC (443 by default).')
-    parser.add_argument('--bios_update_protocol', metavar='<bios_update_protocol>', dest="bios_update_protocol", required=False, help='BIOS update protocol: HTTP or SCP', choices=('HTTP', 'SCP'))
+    parser.add_argument('--bios_update_protocol', metavar='<bios_update_protocol>', dest="bios_update_protocol", required=False, help='BIOS update protocol: HTTP or SCP', choices=BIOS_PROTOCOL_CHOICES)
     parser.add_argument('--config',       metavar='<config_file>',     dest="config_file",  type=str, required=False, help='Configuration file')
     parser.add_argument('--bfcfg',        metavar='<bfcfg>',           dest="bfcfg",        type=str, required=False, help='bf.cfg - BFB configuration file')
     parser.add_argument('-s',             action='append',             metavar="<oem_fru>", dest="oem_fru",           type=str, required=False, help='FRU data in the format "Section:Key=Value"')
@@ -47,64 +101,113 @@ def get_arg_parser():
     parser.add_argument('-L', metavar="<path>", dest="config_path", type=str, required=False, help='Linux path to save the cfg file', default='/tmp')
     parser.add_argument('--task-id',    metavar="<task_id>",    dest="task_id",     type=str, required=False, help='Unique identifier for the task')
     parser.add_argument('--lfwp',       action='store_true',    dest="lfwp",        required=False, help='Live Firmware Update patch. Works only with BUNDLE module. Do not use  –with-config together with this option.', default=False)
+    parser.add_argument('--keep-temp',  action='store_true',    dest="keep_temp",   required=False, help='Do not remove the task directory on exit', default=False)
+    parser.add_argument('--parallel',   metavar="<num>",        dest="parallel",    type=int, required=False, help='Maximum number of BMCs updated at the same time when -H lists several BMCs ({} by default)'.format(MAX_PARALLEL_BMC), default=MAX_PARALLEL_BMC)
     return parser
 
 def cleanup():
-    global task_dir
-    if task_dir:
+    import shutil
+    while task_dirs:
+        task_dir = task_dirs.pop()
         if os.path.exists(task_dir):
-            print("Cleaning up task directory: {}".format(task_dir))
+            log.info("Cleaning up task directory: {}".format(task_dir))
             shutil.rmtree(task_dir)
 
+def get_bfb_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, BFB_CACHE_DIR_NAME)
+
+def is_private_dir(path):
+    # A real directory of this user, which no other user can read or write
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+def reap_stale_temp(config_path):
+    '''
+    Remove task directories and cached merged files of earlier runs that did not
+    get to clean up (killed, crashed), once they are older than STALE_TEMP_SECONDS
+    '''
+    import shutil
+    now = time.time()
+    uid = os.getuid()
+    for top, name_re in ((config_path, TASK_DIR_RE), (get_bfb_cache_dir(), BFB_CACHE_FILE_RE)):
+        try:
+            names = os.listdir(top)
+        except OSError:
+            continue
+        for name in names:
+            if not name_re.match(name):
+                continue
+            path = os.path.join(top, name)
+            try:
+                # Only entries of this user, symlinks are not followed
+                st = os.lstat(path)
+                if st.st_uid != uid or stat.S_ISLNK(st.st_mode) or now - st.st_mtime < STALE_TEMP_SECONDS:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    if not os.path.exists(os.path.join(path, KEEP_TEMP_MARKER)):
+                        shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.unlink(path)
+            except OSError:
+                pass
+
 def signal_handler(signum, frame):
-    global debug
-    if not debug:
-        cleanup()
+    cleanup()
     sys.exit(0)
 
 def create_random_suffix():
-    letters = string.ascii_lowercase
-    return ''.join(random.choice(letters) for i in range(5))
+    # 5 hex chars from a single urandom read
+    return os.urandom(3).hex()[:5]
 
 def create_cfg_file(username, password, ssh_username, ssh_password, task_dir, task_id, lfwp=None, with_config=False, bfcfg=None):
     cfg_file_name = "{}_{}.cfg".format(task_id, create_random_suffix())
     cfg_file_path = os.path.join(task_dir, cfg_file_name)
     try:
-        with open(cfg_file_path, 'w') as cfg_file:
-            cfg_file.write('BMC_USER="{}"\n'.format(username))
-            cfg_file.write('BMC_PASSWORD="{}"\n'.format(password))
-            cfg_file.write('BMC_SSH_USER="{}"\n'.format(ssh_username))
-            cfg_file.write('BMC_SSH_PASSWORD="{}"\n'.format(ssh_password))
-            if lfwp:
-                cfg_file.write('LFWP="yes"\n')
-            else:
-                cfg_file.write('BMC_REBOOT="yes"\n')
-                cfg_file.write('CEC_REBOOT="yes"\n')
-            if with_config:
-                cfg_file.write('UPLOAD_CONFIG_IMAGE="yes"\n')
-            else:
-                cfg_file.write('UPLOAD_CONFIG_IMAGE="no"\n')
-
-            # Check all the files under workaround directory and append their content to the configuration file
-            workaround_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workaround')
-            if os.path.exists(workaround_dir):
-                for file in os.listdir(workaround_dir):
-                    if file.endswith('.cfg'):
-                        with open(os.path.join(workaround_dir, file), 'r') as workaround_file:
-                            cfg_file.write(workaround_file.read() + "\n")
-                        print("Added workaround file: {}".format(os.path.join(workaround_dir, file)))
-
-            if bfcfg:
-                try:
-                    with open(bfcfg, 'r') as bfcfg_file:
-                        cfg_file.write(bfcfg_file.read())
-                except Exception as e:
-                    print("Error reading bfcfg file: {}".format(e))
-                    return None
-        print("Configuration file saved to {}".format(cfg_file_path))
+        cfg = [
+            'BMC_USER="{}"\n'.format(username),
+            'BMC_PASSWORD="{}"\n'.format(password),
+            'BMC_SSH_USER="{}"\n'.format(ssh_username),
+            'BMC_SSH_PASSWORD="{}"\n'.format(ssh_password),
+        ]
+        if lfwp:
+            cfg.append('LFWP="yes"\n')
+        else:
+            cfg.append('BMC_REBOOT="yes"\n')
+            cfg.append('CEC_REBOOT="yes"\n')
+        if with_config:
+            cfg.append('UPLOAD_CONFIG_IMAGE="yes"\n')
+        else:
+            cfg.append('UPLOAD_CONFIG_IMAGE="no"\n')
+
+        # Check all the files under workaround directory and append their content to the configuration file
+        workaround_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workaround')
+        if os.path.exists(workaround_dir):
+            for file in os.listdir(workaround_dir):
+                if file.endswith('.cfg'):
+                    with open(os.path.join(workaround_dir, file), 'r') as workaround_file:
+                        cfg.append(workaround_file.read() + "\n")
+                    log.info("Added workaround file: {}".format(os.path.join(workaround_dir, file)))
+
+        if bfcfg:
+            try:
+                with open(bfcfg, 'r') as bfcfg_file:
+                    cfg.append(bfcfg_file.read())
+            except Exception as e:
+                log.info("Error reading bfcfg file: {}".format(e))
+                return None
+
+        # The file holds credentials, create it readable by the owner only and write it at once
+        fd = os.open(cfg_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as cfg_file:
+            cfg_file.write(''.join(cfg).encode())
+        log.info("Configuration file saved to {}".format(cfg_file_path))
         return cfg_file_path
     except Exception as e:
-        print("Error creating configuration file: {}".format(e))
+        log.info("Error creating configuration file: {}".format(e))
         return None
 
 def make_lfwp_bfb(cfg_file_path, fw_file_path, task_dir, task_id):
@@ -115,25 +218,89 @@ def make_lfwp_bfb(cfg_file_path, fw_file_path, task_dir, task_id):
     try:
         script_dir = os.path.dirname(os.path.abspath(__file__))
         os.system("{script_dir}/src/mlx-mkbfb --boot-args-v0 {cfg_file} {bfb_file} {new_bfb_file}".format(script_dir=script_dir, cfg_file=cfg_file_path, bfb_file=fw_file_path, new_bfb_file=new_fw_path))
-        print("New lfwp bfb file created at {}".format(new_fw_path))
+        log.info("New lfwp bfb file created at {}".format(new_fw_path))
         return new_fw_path
     except Exception as e:
-        print("Error making lfwp bfb file: {}".format(e))
+        log.info("Error making lfwp bfb file: {}".format(e))
         return None
 
-def merge_files(cfg_file_path, fw_file_path, task_dir, task_id):
+def append_file(src, out):
+    """
+    Append the content of file object src to file object out.
+    Use sendfile where available, so the data is copied inside the kernel and never
+    goes through a Python buffer; otherwise write slices of the memory mapped file.
+    """
+    size = os.fstat(src.fileno()).st_size
+    if size == 0:
+        return
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(src.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    offset = 0
+    out.flush()
+    if hasattr(os, 'sendfile'):
+        try:
+            while offset < size:
+                sent = os.sendfile(out.fileno(), src.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError:
+            pass
+        if offset >= size:
+            return
+    with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as mv:
+        while offset < size:
+            offset += os.write(out.fileno(), mv[offset:offset + MERGE_CHUNK_SIZE])
+
+def merge_files(cfg_file_path, fw_file_path, task_dir, task_id, cache_dir=None):
     if not cfg_file_path or not fw_file_path or not fw_file_path.endswith('.bfb'):
         return fw_file_path
     new_fw_name = "{}_{}_new.bfb".format(task_id, create_random_suffix())
     new_fw_path = os.path.join(task_dir, new_fw_name)
     try:
-        with open(fw_file_path, 'rb') as f1, open(cfg_file_path, 'rb') as f2, open(new_fw_path, 'wb') as out:
-            shutil.copyfileobj(f1, out)
-            shutil.copyfileobj(f2, out)
-        print("New merged file created at {}".format(new_fw_path))
+        # The cfg file is a few hundred bytes, it is written with a single write
+        with open(cfg_file_path, 'rb') as f:
+            cfg_bytes = f.read()
+        # The merged file is content addressed by (firmware, cfg), so reruns with the
+        # same inputs reuse the file built before instead of copying the firmware again
+        if cache_dir:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+            # makedirs() keeps a directory found in place: do not reuse (or leave)
+            # merged files where another user may have put or read them
+            if not is_private_dir(cache_dir):
+                log.info("Not using cache directory {}: not private to the user".format(cache_dir))
+                cache_dir = None
+        if cache_dir:
+            h, = hash_file(fw_file_path, hashlib.blake2b(digest_size=16))
+            h.update(cfg_bytes)
+            cached_fw_path = os.path.join(cache_dir, "{}.bfb".format(h.hexdigest()))
+            if os.path.exists(cached_fw_path):
+                log.info("Reusing merged file {}".format(cached_fw_path))
+                # Keep the reaper of stale files away from entries still in use
+                os.utime(cached_fw_path)
+            else:
+                fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+                try:
+                    with open(fw_file_path, 'rb') as f1, os.fdopen(fd, 'wb') as out:
+                        append_file(f1, out)
+                        out.write(cfg_bytes)
+                    os.rename(tmp_path, cached_fw_path)
+                except Exception:
+                    os.unlink(tmp_path)
+                    raise
+            # Hard link the cached file into the task directory, so the task keeps its own file
+            try:
+                os.link(cached_fw_path, new_fw_path)
+            except OSError:
+                new_fw_path = cached_fw_path
+        else:
+            with open(fw_file_path, 'rb') as f1, open(new_fw_path, 'wb') as out:
+                append_file(f1, out)
+                out.write(cfg_bytes)
+        log.info("New merged file created at {}".format(new_fw_path))
         return new_fw_path
     except Exception as e:
-        print("Error merging files: {}".format(e))
+        log.info("Error merging files: {}".format(e))
         return None
 
 def extract_info_json(file_path, start_pattern, end_pattern):
@@ -143,7 +310,7 @@ def extract_info_json(file_path, start_pattern, end_pattern):
         with open(file_path, 'rb') as f:
             binary_data = f.read()
     except Exception as e:
-        print("Error opening file: {}".format(e))
+        log.info("Error opening file: {}".format(e))
         return None
 
     # Decode the binary data into a string (ignoring decoding errors)
@@ -156,28 +323,28 @@ def extract_info_json(file_path, start_pattern, end_pattern):
     start_idx = text_data.find(start_pattern)
     if start_idx == -1:
         if debug:
-            print("Start pattern not found.")
+            log.info("Start pattern not found.")
         return None
 
     # Find the first '{' before the start pattern
     open_brace_idx = text_data.rfind('{', 0, start_idx)
     if open_brace_idx == -1:
         if debug:
-            print("No opening brace '{' found before start pattern.")
+            log.info("No opening brace '{' found before start pattern.")
         return None
 
     # Find end pattern and closing '}' after it
     end_idx = text_data.find(end_pattern, open_brace_idx)
     if end_idx == -1:
         if debug:
-            print("End pattern not found.")
+            log.info("End pattern not found.")
         return None
 
     # Find the first '}' after the end pattern
     close_brace_idx = text_data.find('}', end_idx)
     if close_brace_idx == -1:
         if debug:
-            print("No closing brace '}' found after end pattern.")
+            log.info("No closing brace '}' found after end pattern.")
         return None
 
     # Extract the JSON segment
@@ -197,7 +364,7 @@ def extract_info(new_fw_file_path, task_dir, task_id):
         with open(info_file_path, 'w') as info_file:
             info_file.write(info_json)
     except Exception as e:
-        print("Error creating info file: {}".format(e))
+        log.info("Error creating info file: {}".format(e))
         return None
     return info_file_path
 
@@ -208,7 +375,6 @@ def info_has_softwareid(info_data, softwareid):
     return False
 
 
-IS_SPECIAL_TARGET_292_54_BFB = False
 # Constant default config filename in the script directory.
 DEFAULT_292_54_CFG_NAME = "BD-config-2.0-image.bfb"
 DEFAULT_292_54_CFG_VER = '2'
@@ -241,6 +407,21 @@ def get_md5sum(file_path):
             h.update(chunk)
     return h.hexdigest()
 
+def hash_file(file_path, *hashes):
+    """
+    Feed the whole file into every hash object of hashes and return them.
+    The file is memory mapped once and each hash consumes the whole buffer in one call,
+    so the data goes through the (SHA-NI accelerated) openssl code path without Python
+    level chunking, and is read from disk only once whatever the number of hashes.
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashes
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as mv:
+            for h in hashes:
+                h.update(mv)
+    return hashes
+
 def pick_config_bfb(args):
     """
     Resolve config bfb path by priority:
@@ -253,7 +434,7 @@ def pick_config_bfb(args):
         if os.path.exists(args.config_file):
             return args.config_file
         else:
-            print("[warn] --config file not found: {}".format(args.config_file))
+            log.info("[warn] --config file not found: {}".format(args.config_file))
 
     # 2) Look for default name alongside the script
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -263,49 +444,96 @@ def pick_config_bfb(args):
     # Nothing found
     return None
 
-def main():
-    parser = get_arg_parser()
-    args   = parser.parse_args()
-    reset_bios = False
-    info_data = None
-    new_fw_file_path = None
-    global task_dir
-    global debug
-    debug = args.debug
+# Arguments required for any BMC access: (attribute, option)
+REQUIRED_ARGS = (('username', '-U'), ('password', '-P'), ('bmc_ip', '-H'))
 
-    if args.show_version:
-        print(Version)
-        return 0
-    if not (
-        args.username and args.password and args.bmc_ip
-    ):
-        print("Please use -h/--help to get help informations, "
-              "the following arguments are required for Update: -U, -P, -H.")
+def parse_bmc_ips(bmc_ip):
+    '''
+    BMC addresses of -H (comma-separated), blanks dropped; a BMC given twice is
+    updated once, two updates of one BMC at the same time would race
+    '''
+    return list(dict.fromkeys(ip.strip() for ip in bmc_ip.split(',') if ip.strip()))
+
+def validate_args(args):
+    """
+    Validate the command line arguments in one pass.
+    Return None if main() can go on, otherwise the exit code of main().
+    """
+    missing = [opt for attr, opt in REQUIRED_ARGS if not getattr(args, attr)]
+    if missing:
+        log.info("Please use -h/--help to get help informations, "
+              "the following arguments are required for Update: {}.".format(', '.join(missing)))
         return 0
+
     if args.module:
         if not (args.fw_file_path or args.clear_config or args.oem_fru):
-            print("Argument -F, -C or -s is required while -T is provided")
+            log.info("Argument -F, -C or -s is required while -T is provided")
             return 0
 
-        if args.fw_file_path:
-            real_fw_file_path = os.path.realpath(args.fw_file_path)
-            if not os.path.exists(real_fw_file_path):
-                print("File {} does not exist".format(real_fw_file_path))
-                return 1
-            args.fw_file_path = real_fw_file_path
+        if args.fw_file_path and not os.path.exists(args.fw_file_path):
+            log.info("File {} does not exist".format(args.fw_file_path))
+            return 1
+
+        if args.module == 'BUNDLE' and not (args.ssh_username and args.ssh_password):
+            log.info("SSH Username -S and SSH Password -K are required for BUNDLE update")
+            return 1
+
+    if not parse_bmc_ips(args.bmc_ip):
+        from error_num import Err_Num, Err_Exception
+        sys.stderr.write("[Error Happened]:\n\t" + str(Err_Exception(Err_Num.INVALID_BMC_ADDRESS, 'No BMC address in -H "{}"'.format(args.bmc_ip))) + '\n')
+        return Err_Num.INVALID_BMC_ADDRESS.value
+
+    if args.parallel < 1:
+        log.info("Argument --parallel must be at least 1")
+        return 1
+    return None
+
+def main(argv=None):
+    args = get_arg_parser().parse_args(argv)
+    if args.show_version:
+        print(Version)
+        return 0
+    return run_update(UpdateCfg(**{name: getattr(args, name) for name in UpdateCfg._fields}))
+
+def run_update(args):
+    '''
+    Run the update described by args, an UpdateCfg.
+    Return the exit code of the tool.
+    '''
+    reset_bios = False
+    info_data = None
+    new_fw_file_path = None
+    bundle_cfg_file = None
+    global debug
+    debug = args.debug
+    # Set when the firmware file is the special 2.9.2-54 BFB, for this call only
+    is_special_target_292_54_bfb = False
+
+    # Imported here, so that -v does not pay for loading the update module
+    import bf_dpu_update
+    if args.module and args.fw_file_path:
+        args = args._replace(fw_file_path=os.path.realpath(args.fw_file_path))
+    ret = validate_args(args)
+    if ret is not None:
+        return ret
 
     # Ensure a task ID is provided
     if not args.task_id:
-        args.task_id = str(int(time.time() * 1000))
+        # pid + monotonic clock: unique across concurrent runs, no float math
+        args = args._replace(task_id="{}_{}".format(os.getpid(), time.monotonic_ns()))
 
+    reap_stale_temp(args.config_path)
     task_dir = os.path.join(args.config_path, "task_{}_{}".format(args.task_id, create_random_suffix()))
     # Create a separate temporary directory for each task
-    if not os.path.exists(task_dir):
-        try:
-            os.makedirs(task_dir)
-        except OSError as e:
-            print("Error creating directory {}: {}".format(task_dir, e))
-            return 1
+    try:
+        os.makedirs(task_dir, exist_ok=True)
+    except OSError as e:
+        log.info("Error creating directory {}: {}".format(task_dir, e))
+        return 1
+    if not args.debug and not args.keep_temp:
+        task_dirs.append(task_dir)
+    else:
+        open(os.path.join(task_dir, KEEP_TEMP_MARKER), 'w').close()
 
     # ---------------------------------------------------------------------
     # Special-case policy:
@@ -339,54 +567,54 @@ def main():
     config_filename = None
     config_file_md5 = None
     cfg_path = None
-    global IS_SPECIAL_TARGET_292_54_BFB
-    global DEFAULT_292_54_CFG_NAME
+    # Digest of the firmware file, used to skip the upload if BMC already runs the same image
+    need_fw_digest = args.skip_same_version and args.module in bf_dpu_update.BF_DPU_Update.digest_module
+    new_fw_digest = None
     try:
         if getattr(args, 'fw_file_path', None) and os.path.exists(args.fw_file_path):
             bfb_filename = os.path.basename(args.fw_file_path)
-            bfb_file_md5 = get_md5sum(args.fw_file_path)
+            if need_fw_digest:
+                # md5 and sha256 are computed over the same mapping of the file
+                md5, sha256 = hash_file(args.fw_file_path, hashlib.md5(), hashlib.sha256())
+                bfb_file_md5, new_fw_digest = md5.hexdigest(), sha256.hexdigest()
+                if debug:
+                    log.info("Firmware file sha256: {}".format(new_fw_digest))
+            else:
+                bfb_file_md5 = get_md5sum(args.fw_file_path)
             if bfb_file_md5 in BFB_292_54_MD5_LIST:
                 if getattr(args, 'with_config', False):
-                    print("Detected special image (file: {}, MD5 {}). --with-config will be ignored for this image.".format(bfb_filename, bfb_file_md5))
+                    log.info("Detected special image (file: {}, MD5 {}). --with-config will be ignored for this image.".format(bfb_filename, bfb_file_md5))
 
-                IS_SPECIAL_TARGET_292_54_BFB = True
-                args.with_config = False
+                is_special_target_292_54_bfb = True
+                args = args._replace(with_config=False)
 
                 # check config file and MD5
                 cfg_path = pick_config_bfb(args)
                 if not cfg_path:
-                    print("ERROR: special image (file: {}, MD5 {}). No config bfb('{}') found.".format(bfb_filename, bfb_file_md5, DEFAULT_292_54_CFG_NAME))
+                    log.info("ERROR: special image (file: {}, MD5 {}). No config bfb('{}') found.".format(bfb_filename, bfb_file_md5, DEFAULT_292_54_CFG_NAME))
                     return 1
                 else:
                     config_filename = os.path.basename(cfg_path)
                     config_file_md5 = get_md5sum(cfg_path)
                     if not config_file_md5 == BFB_292_54_CONFIG_MD5:
                         # not correct config.bfb provided, rejected
-                        print("special image (file: {}, MD5 {}) check config file failed: (file: {}, MD5 {}) ".format(bfb_filename, bfb_file_md5, config_filename, config_file_md5))
+                        log.info("special image (file: {}, MD5 {}) check config file failed: (file: {}, MD5 {}) ".format(bfb_filename, bfb_file_md5, config_filename, config_file_md5))
                         return 1
 
-                print("special image (file: {}, MD5 {}) find config file: (file: {}, MD5 {}) ".format(bfb_filename, bfb_file_md5, config_filename, config_file_md5))
+                log.info("special image (file: {}, MD5 {}) find config file: (file: {}, MD5 {}) ".format(bfb_filename, bfb_file_md5, config_filename, config_file_md5))
 
             elif bfb_file_md5 in BFB_293_39_MD5_LIST:
                 if not getattr(args, 'with_config', False):
-                    print("Detected special image (file: {}, MD5 {}). --with-config needs to be added for this image.".format(bfb_filename, bfb_file_md5))
-                args.with_config = True
+                    log.info("Detected special image (file: {}, MD5 {}). --with-config needs to be added for this image.".format(bfb_filename, bfb_file_md5))
+                args = args._replace(with_config=True)
 
     except Exception as _e:
         if debug:
-            print("Warning: failed to compute md5 for '{getattr(args, 'fw_file_path', None)}': {}".format(_e))
+            log.info("Warning: failed to compute md5 for '{}': {}".format(getattr(args, 'fw_file_path', None), _e))
     # ---------------------------------------------------------------------
 
     if args.module:
-        if not args.username or not args.password:
-            print("Username -U and password -P are required for modules update")
-            return 1
-
         if args.module == 'BUNDLE':
-            if not args.ssh_username or not args.ssh_password:
-                print("SSH Username -S and SSH Password -K are required for BUNDLE update")
-                return 1
-
             # Only call file creation and merging functions when executing upgrade actions with -T BUNDLE
             # Create configuration file
             cfg_file_path = create_cfg_file(args.username, args.password, args.ssh_username, args.ssh_password, task_dir, args.task_id, args.lfwp, args.with_config, args.bfcfg)
@@ -396,161 +624,220 @@ def main():
             if args.lfwp:
                 # Make lfwp bfb file
                 new_fw_file_path = make_lfwp_bfb(cfg_file_path, args.fw_file_path, task_dir, args.task_id)
+            elif args.bios_update_protocol == 'SCP':
+                # SCP needs the merged file on disk
+                new_fw_file_path = merge_files(cfg_file_path, args.fw_file_path, task_dir, args.task_id, get_bfb_cache_dir())
             else:
-                # Merge files
-                new_fw_file_path = merge_files(cfg_file_path, args.fw_file_path, task_dir, args.task_id)
+                # The local HTTP server sends the firmware followed by the cfg file,
+                # no merged file is written (merged on demand if BMC only supports SCP)
+                new_fw_file_path = args.fw_file_path
+                if new_fw_file_path.endswith('.bfb'):
+                    bundle_cfg_file = cfg_file_path
 
             if not new_fw_file_path:
                 return 1
 
             info_file_path = extract_info(new_fw_file_path, task_dir, args.task_id)
             if info_file_path:
-                print("Info file created at {}".format(info_file_path))
+                log.info("Info file created at {}".format(info_file_path))
                 try:
                     info_data = json.load(open(info_file_path))
                 except Exception as e:
-                    print("Error loading info file: {}".format(e))
+                    log.info("Error loading info file: {}".format(e))
                     return 1
                 if info_has_softwareid(info_data, 'config-image.bfb') and args.with_config:
                     reset_bios = True
             else:
-                print("No info file found in the bundle file")
+                log.info("No info file found in the bundle file")
         else:
             if args.fw_file_path:
                 new_fw_file_path = args.fw_file_path
     else:
         new_fw_file_path = args.fw_file_path
 
-    try:
-        if IS_SPECIAL_TARGET_292_54_BFB:
-            dpu_config = bf_dpu_update.BF_DPU_Update(args.bmc_ip,
+    # Reuse one SSH connection per BMC for the ssh commands run on BMC
+    use_ssh_mux = bool(args.ssh_username and args.ssh_password)
+    ssh_mux = None
+    if use_ssh_mux:
+        # The sockets go in a directory only this user can access (mode 0700 from
+        # mkdtemp), a fixed name in world-writable /tmp could be taken over by another user
+        runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+        ssh_mux_dir = tempfile.mkdtemp(prefix='bfmux_', dir=runtime_dir if runtime_dir and os.path.isdir(runtime_dir) else None)
+        ssh_mux = os.path.join(ssh_mux_dir, SSH_MUX_CONTROL_NAME)
+
+    def update_one(bmc_ip):
+        ssh_mux_owner = None
+        # Each one stops the master connection it started (see stop_ssh_mux)
+        ssh_mux_users = []
+        try:
+            # One HTTP session per BMC, shared by the firmware and config updates
+            session = bf_dpu_update.get_http_session(bmc_ip, args.bmc_port, args.username)
+            if is_special_target_292_54_bfb:
+                dpu_config = bf_dpu_update.BF_DPU_Update(bmc_ip,
+                                                         args.bmc_port,
+                                                         args.username,
+                                                         args.password,
+                                                         args.ssh_username,
+                                                         args.ssh_password,
+                                                         cfg_path,
+                                                         task_dir,
+                                                         'CONFIG',
+                                                         args.oem_fru,
+                                                         args.skip_same_version,
+                                                         args.debug,
+                                                         args.output_file,
+                                                         bfb_update_protocol = args.bios_update_protocol,
+                                                         use_curl = True,
+                                                         version = Version,
+                                                         session = session,
+                                                         ssh_mux = ssh_mux)
+                ssh_mux_users.append(dpu_config)
+                if use_ssh_mux and dpu_config.start_ssh_mux():
+                    ssh_mux_owner = dpu_config
+
+                dpu_config.check_bmc_availability()
+                curr_config_ver = dpu_config.get_ver('CONF_IMAGE')
+                log.info("special image (file: {}, MD5 {}) config: {}".format(bfb_filename, bfb_file_md5, curr_config_ver))
+                if curr_config_ver == DEFAULT_292_54_CFG_VER:
+                    # current config version is same as target 292-54's config version 2.0
+                    log.info("special image (file: {}, MD5 {}) upgrade/downgrade step1: config not changed: {}, skip update".format(bfb_filename, bfb_file_md5, curr_config_ver))
+                else:
+                    log.info("special image (file: {}, MD5 {}) upgrade/downgrade step1: config update start".format(bfb_filename, bfb_file_md5))
+
+                    dpu_config.do_update()
+
+                    log.info("special image (file: {}, MD5 {}) upgrade/downgrade step1: config update success".format(bfb_filename, bfb_file_md5))
+                    time.sleep(5)
+                    dpu_config.show_all_versions()
+                    time.sleep(5)
+
+                log.info("special image (file: {}, MD5 {}) upgrade/downgrade step2: FWBundle update start".format(bfb_filename, bfb_file_md5))
+
+            dpu_update = bf_dpu_update.BF_DPU_Update(bmc_ip,
                                                      args.bmc_port,
                                                      args.username,
                                                      args.password,
                                                      args.ssh_username,
                                                      args.ssh_password,
-                                                     cfg_path,
+                                                     new_fw_file_path,
                                                      task_dir,
-                                                     'CONFIG',
+                                                     args.module,
                                                      args.oem_fru,
                                                      args.skip_same_version,
                                                      args.debug,
                                                      args.output_file,
-                                                     bfb_update_protocol = args.bios_update_protocol,
                                                      use_curl = True,
-                                                     version = Version)
-
-            dpu_config.check_bmc_availability()
-            curr_config_ver = dpu_config.get_ver('CONF_IMAGE')
-            print("special image (file: {}, MD5 {}) config: {}".format(bfb_filename, bfb_file_md5, curr_config_ver))
-            if curr_config_ver == DEFAULT_292_54_CFG_VER:
-                # current config version is same as target 292-54's config version 2.0
-                print("special image (file: {}, MD5 {}) upgrade/downgrade step1: config not changed: {}, skip update".format(bfb_filename, bfb_file_md5, curr_config_ver))
-            else:
-                print("special image (file: {}, MD5 {}) upgrade/downgrade step1: config update start".format(bfb_filename, bfb_file_md5))
+                                                     bfb_update_protocol = args.bios_update_protocol,
+                                                     reset_bios = reset_bios,
+                                                     lfwp = args.lfwp,
+                                                     version = Version,
+                                                     session = session,
+                                                     cfg_file = bundle_cfg_file,
+                                                     ssh_mux = ssh_mux)
+            ssh_mux_users.append(dpu_update)
+            if info_data:
+                dpu_update.set_info_data(info_data)
+
+            if args.show_all_versions:
+                dpu_update.show_all_versions()
+                return 0
+
+            if use_ssh_mux and ssh_mux_owner is None and dpu_update.start_ssh_mux():
+                ssh_mux_owner = dpu_update
+
+            mode = dpu_update.get_dpu_mode()
+            if debug:
+                log.info('DPU mode: {}'.format(mode))
+
+            if mode == 'NicMode' and args.lfwp:
+                log.info('Live Firmware Update patch is not supported in NIC mode')
+                return 1
 
+            if new_fw_digest and dpu_update.get_fw_digest() == new_fw_digest:
+                log.info("Skip updating the same firmware image (sha256 {})".format(new_fw_digest))
+            elif args.fw_file_path is not None or args.oem_fru is not None:
+                dpu_update.do_update()
+
+                log.info("Upgrade finished!")
+
+            if is_special_target_292_54_bfb:
+                log.info("special image (file: {}, MD5 {}) upgrade/downgrade step2: FWBundle updated success".format(bfb_filename, bfb_file_md5))
+            elif args.config_file is not None:
+                dpu_config = bf_dpu_update.BF_DPU_Update(bmc_ip,
+                                                         args.bmc_port,
+                                                         args.username,
+                                                         args.password,
+                                                         args.ssh_username,
+                                                         args.ssh_password,
+                                                         args.config_file,
+                                                         task_dir,
+                                                         'CONFIG',
+                                                         args.oem_fru,
+                                                         args.skip_same_version,
+                                                         args.debug,
+                                                         args.output_file,
+                                                         bfb_update_protocol = args.bios_update_protocol,
+                                                         use_curl = True,
+                                                         version = Version,
+                                                         session = session,
+                                                         ssh_mux = ssh_mux)
+                ssh_mux_users.append(dpu_config)
                 dpu_config.do_update()
 
-                print("special image (file: {}, MD5 {}) upgrade/downgrade step1: config update success".format(bfb_filename, bfb_file_md5))
-                time.sleep(5)
-                dpu_config.show_all_versions()
-                time.sleep(5)
-
-            print("special image (file: {}, MD5 {}) upgrade/downgrade step2: FWBundle update start".format(bfb_filename, bfb_file_md5))
-
-        dpu_update = bf_dpu_update.BF_DPU_Update(args.bmc_ip,
-                                                 args.bmc_port,
-                                                 args.username,
-                                                 args.password,
-                                                 args.ssh_username,
-                                                 args.ssh_password,
-                                                 new_fw_file_path,
-                                                 task_dir,
-                                                 args.module,
-                                                 args.oem_fru,
-                                                 args.skip_same_version,
-                                                 args.debug,
-                                                 args.output_file,
-                                                 use_curl = True,
-                                                 bfb_update_protocol = args.bios_update_protocol,
-                                                 reset_bios = reset_bios,
-                                                 lfwp = args.lfwp,
-                                                 version = Version)
-        if info_data:
-            dpu_update.set_info_data(info_data)
-
-        if args.show_all_versions:
-            dpu_update.show_all_versions()
-            return 0
+            if args.clear_config:
+                dpu_update.reset_config()
 
-        mode = dpu_update.get_dpu_mode()
-        if debug:
-            print('DPU mode: {}'.format(mode))
+            return 0
 
-        if mode == 'NicMode' and args.lfwp:
-            print('Live Firmware Update patch is not supported in NIC mode')
+        except bf_dpu_update.Err_Exception as e:
+            sys.stderr.write("[Error Happened]:\n\t" + str(e) + '\n')
+            if args.debug:
+                import traceback
+                traceback.print_exc()
+            return e.err_num.value
+        except KeyboardInterrupt:
+            log.info("Keyboard interrupt")
             return 1
-
-        if args.fw_file_path is not None or args.oem_fru is not None:
-            dpu_update.do_update()
-
-            print("Upgrade finished!")
-
-        if IS_SPECIAL_TARGET_292_54_BFB:
-            print("special image (file: {}, MD5 {}) upgrade/downgrade step2: FWBundle updated success".format(bfb_filename, bfb_file_md5))
-        else:
-            if args.config_file is not None:
-                dpu_config = bf_dpu_update.BF_DPU_Update(args.bmc_ip,
-                                                        args.bmc_port,
-                                                        args.username,
-                                                        args.password,
-                                                        args.ssh_username,
-                                                        args.ssh_password,
-                                                        args.config_file,
-                                                        task_dir,
-                                                        'CONFIG',
-                                                        args.oem_fru,
-                                                        args.skip_same_version,
-                                                        args.debug,
-                                                        args.output_file,
-                                                        bfb_update_protocol = args.bios_update_protocol,
-                                                        use_curl = True,
-                                                        version = Version)
-                dpu_config.do_update()
-
-        if args.clear_config:
-            dpu_update.reset_config()
-
-        return 0
-
-    except bf_dpu_update.Err_Exception as e:
-        sys.stderr.write("[Error Happened]:\n\t" + str(e) + '\n')
-        if args.debug:
-            import traceback
-            traceback.print_exc()
-        else:
-            cleanup()
-        return e.err_num.value
-    except KeyboardInterrupt:
-        print("Keyboard interrupt")
-        if not args.debug:
-            cleanup()
-        return 1
-    except Exception as e:
-        sys.stderr.write("[Error Happened]:\n\t" + str(e) + '; please use -d to get detail info \n')
-        if args.debug:
-            import traceback
-            traceback.print_exc()
-        else:
-            cleanup()
-        return bf_dpu_update.Err_Num.OTHER_EXCEPTION.value
+        except Exception as e:
+            sys.stderr.write("[Error Happened]:\n\t" + str(e) + '; please use -d to get detail info \n')
+            if args.debug:
+                import traceback
+                traceback.print_exc()
+            return bf_dpu_update.Err_Num.OTHER_EXCEPTION.value
+        finally:
+            for dpu in ssh_mux_users:
+                dpu.stop_ssh_mux()
+            # The log of this BMC is complete, also after an error
+            bf_dpu_update.flush_log_files()
+
+    bmc_ips = parse_bmc_ips(args.bmc_ip)
+    try:
+        if len(bmc_ips) == 1:
+            return update_one(bmc_ips[0])
+
+        # Each BMC is updated independently; the work is network bound, so one thread per BMC
+        ret = 0
+        with ThreadPoolExecutor(max_workers=min(args.parallel, len(bmc_ips))) as executor:
+            futures = {executor.submit(update_one, bmc_ip): bmc_ip for bmc_ip in bmc_ips}
+            for future in as_completed(futures):
+                bmc_ip = futures[future]
+                host_ret = future.result()
+                if host_ret != 0:
+                    log.info("BMC {}: update failed with error code {}".format(bmc_ip, host_ret))
+                else:
+                    log.info("BMC {}: update finished".format(bmc_ip))
+                ret = max(ret, host_ret)
+        return ret
+    finally:
+        # The master connections of this call are stopped by now
+        if use_ssh_mux:
+            import shutil
+            shutil.rmtree(ssh_mux_dir, ignore_errors=True)
 
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
+atexit.register(cleanup)
 
 if __name__ == '__main__':
     ret = main()
-    if not debug:
-        cleanup()
-
     sys.exit(ret)
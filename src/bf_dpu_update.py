@@ -3,21 +3,133 @@
 # Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
 
 
+import atexit
 import time
 import re
 import sys
 import os
 import json
 import socket
-import select
 import getpass
 import subprocess
+import shlex
 import stat
+import mmap
 import datetime
-from multiprocessing import Process
+import functools
 from error_num import *
 import random
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+# HTTP sessions shared by all BF_DPU_Update objects talking to the same BMC,
+# keyed by (bmc_ip, bmc_port, username, use_curl)
+_session_cache = {}
+_session_lock  = threading.Lock()
+
+
+def get_http_session(bmc_ip, bmc_port, username, use_curl=True):
+    key = (bmc_ip, bmc_port, username, use_curl)
+    with _session_lock:
+        if key not in _session_cache:
+            if use_curl:
+                from http_accessor_curl import create_session
+            else:
+                from http_accessor_requests import create_session
+            _session_cache[key] = create_session()
+        return _session_cache[key]
+
+
+@atexit.register
+def _close_http_sessions():
+    with _session_lock:
+        for session in _session_cache.values():
+            if session is not None:
+                session.close()
+        _session_cache.clear()
+
+
+# Versions in the names of CEC (00.02.0195.0000) and BMC (24.10-24) firmware files
+_CEC_VER_RE = re.compile(r'\d\d\.\d\d\.\d{4}\.\d{4}')
+_BMC_VER_RE = re.compile(r'\d\d\.\d\d-\d')
+
+
+# Markers of the firmware types, found in the file case-insensitively (as "strings | grep -i")
+_FW_TYPE_MARKERS   = (b'apfw', b'ecfw', b'toutiao')
+# ATF/UEFI version string markers, found case-sensitively
+_FW_ATF_VER_MARKERS = (b'(release)', b'(debug)')
+# Printable characters of a string, as "strings" sees them
+_PRINTABLE_BYTES   = frozenset(range(0x20, 0x7f)) | {0x09}
+# Size of the blocks the firmware file is scanned in
+FW_SCAN_CHUNK_SIZE = 16 << 20
+
+
+# Shape of the FRU ManufactureDate: DD/MM/YYYY HH:MM:SS (strptime also takes single digits)
+_FRU_DATE_RE = re.compile(r'^\d{1,2}/\d{1,2}/\d{4} \d{1,2}:\d{1,2}:\d{1,2}$')
+
+
+# Markers found in firmware files, keyed by (path, size, mtime)
+_fw_markers_cache = {}
+_fw_markers_lock  = threading.Lock()
+
+
+# Keys of the local SSH server scanned by ssh-keyscan, keyed by local address
+_local_pub_keys      = {}
+_local_pub_keys_lock = threading.Lock()
+
+
+# Errors of reading a field out of a Redfish response body (not JSON, missing key,
+# wrong type); only these mean a bad response format, anything else is let through
+_RESPONSE_FORMAT_ERRORS = (ValueError, KeyError, IndexError, TypeError, AttributeError)
+
+
+# Firmware inventory entries read from BMC at a time; more would only load its web server
+MAX_VERSION_QUERIES = 8
+# Time between the tries of get_ver() it keeps retrying for (that of the former
+# fixed sleeps): the version may be empty for a while after BMC/CEC rebooted
+GET_VER_RETRY_SECONDS = 4
+
+
+# Last time each BMC (bmc_ip, bmc_port) was found available, shared by all objects;
+# a later check within BMC_AVAILABLE_TTL seconds is answered without a request
+BMC_AVAILABLE_TTL    = 30
+_bmc_available       = {}
+_bmc_available_lock  = threading.Lock()
+
+
+def _backoff_iter(initial=0.5, cap=4.0, factor=2.0, jitter=0.2):
+    '''
+    Yield the sleep intervals of a polling loop: growing from initial by factor up
+    to cap, each spread by +-jitter so that the polls of DPUs updated in parallel
+    do not line up
+    '''
+    delay = initial
+    while True:
+        yield delay * random.uniform(1 - jitter, 1 + jitter)
+        delay = min(delay * factor, cap)
+
+
+# Log files of BF_DPU_Update objects keyed by path: one buffered handle per file is
+# shared by all objects and threads, entries are written under _log_file_lock
+_log_files     = {}
+_log_file_lock = threading.Lock()
+
+
+def _get_log_file(path):
+    with _log_file_lock:
+        if path not in _log_files:
+            f = open(path, 'a', buffering=1 << 16)
+            atexit.register(f.close)
+            _log_files[path] = f
+        return _log_files[path]
+
+
+def flush_log_files():
+    # Write out what the log files buffer, e.g. when an update ends or fails
+    with _log_file_lock:
+        for f in _log_files.values():
+            f.flush()
 
 
 class BF_DPU_Update(object):
@@ -38,8 +150,51 @@ class BF_DPU_Update(object):
         'BOARD'     : 'DPU_BOARD'
     }
 
+    # Inventory entry that reports the package digest of the module being updated
+    digest_module = {
+        'BMC'       : 'BMC',
+        'CEC'       : 'CEC',
+        'BIOS'      : 'ATF',
+    }
+
+    # Headers and bodies of the reset/clear actions, they never change
+    _JSON_HEADERS         = {'Content-Type' : 'application/json'}
+    _OCTET_HEADERS        = {'Content-Type' : 'application/octet-stream'}
+    _RESET_GRACEFUL_BODY  = json.dumps({'ResetType' : 'GracefulRestart'})
+    _RESET_TO_ALL_BODY    = json.dumps({'ResetToDefaultsType' : 'ResetAll'})
+    _EMPTY_JSON_BODY      = '{}'
+
+    # BMC version: optional BF- prefix, then major, minor and patch separated by '.' or '-'
+    _VER_RE               = re.compile(r'^(?:BF-)?(\d+)[.\-](\d+)[.\-](\d+)')
+
+    # Update and configuration reset of each module (-T), see do_update() and reset_config()
+    _UPDATE_DISPATCH       = {
+        'BMC'    : lambda self: self.update_bmc_or_cec(True),
+        'CEC'    : lambda self: self.update_bmc_or_cec(False),
+        'BIOS'   : lambda self: self.update_bios(),
+        'FRU'    : lambda self: self.update_oem_fru(),
+        'CONFIG' : lambda self: self.update_conf(),
+        'BUNDLE' : lambda self: self.update_bundle()
+    }
+    _RESET_CONFIG_DISPATCH = {
+        'BMC'    : lambda self: self.factory_reset_bmc(),
+        'BIOS'   : lambda self: self.send_reset_bios()
+    }
+
+    # Names of the modules in the info file of a BFB bundle
+    _INFO_MODULE          = {
+        'ATF'  : 'BF3_ATF',
+        'UEFI' : 'BF3_UEFI',
+        'BMC'  : 'BF3_BMC_FW',
+        'CEC'  : 'BF3_CEC_FW',
+        'NIC'  : 'BF3_NIC_FW'
+    }
+
+    # ?$expand=.($levels=1) percent-encoded, the curl command line goes through a shell
+    _EXPAND_MEMBERS_QUERY = '?%24expand=.%28%24levels%3D1%29'
 
-    def __init__(self, bmc_ip, bmc_port, username, password, ssh_username, ssh_password, fw_file_path, task_dir, module, oem_fru, skip_same_version, debug=False, log_file=None, use_curl=True, bfb_update_protocol = None, reset_bios = False, lfwp = False, version = None):
+
+    def __init__(self, bmc_ip, bmc_port, username, password, ssh_username, ssh_password, fw_file_path, task_dir, module, oem_fru, skip_same_version, debug=False, log_file=None, use_curl=True, bfb_update_protocol = None, reset_bios = False, lfwp = False, version = None, session = None, cfg_file = None, ssh_mux = None):
         self.bmc_ip            = self._parse_bmc_addr(bmc_ip)
         self.bmc_port          = bmc_port
         self.username          = username
@@ -47,7 +202,22 @@ class BF_DPU_Update(object):
         self.ssh_username      = ssh_username
         self.ssh_password      = ssh_password
         self.ssh               = "ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o LogLevel=ERROR"
+        # ControlPath of the SSH master connection to BMC (see start_ssh_mux), if enabled by the caller
+        self.ssh_mux           = ssh_mux
+        if self.ssh_mux:
+            self.ssh += " -o ControlPath={}".format(self.ssh_mux)
+        # Whether this object started the SSH master connection (only then stop_ssh_mux() stops it)
+        self.ssh_mux_started   = False
+        # Secrets to hide in the log, matched in one pass (longest first, so a secret
+        # containing another one is replaced as a whole)
+        self._redact_map       = {}
+        for secret, placeholder in ((password, '<password>'), (username, '<username>'),
+                                    (ssh_password, '<ssh_password>'), (ssh_username, '<ssh_username>')):
+            if secret:
+                self._redact_map.setdefault(secret, placeholder)
+        self._redact_re        = re.compile('|'.join(re.escape(secret) for secret in sorted(self._redact_map, key=len, reverse=True))) if self._redact_map else None
         self.fw_file_path      = fw_file_path
+        self.cfg_file          = cfg_file
         self.task_dir          = task_dir
         self.module            = module
         self.oem_fru           = oem_fru
@@ -56,17 +226,36 @@ class BF_DPU_Update(object):
         self.log_file          = log_file
         self.protocol          = 'https://'
         self.redfish_root      = '/redfish/v1'
+        # The BMC address does not change, build the URL prefixes once
+        self._prot_ip_port     = self.protocol + self._format_ip(self.bmc_ip) + ('' if self.bmc_port is None else ':{}'.format(self.bmc_port))
+        self._url_base         = self._prot_ip_port + self.redfish_root
+        # FirmwareInventory URI of each module, polled many times while waiting for BMC
+        self.module_uri        = {module: self._get_firmware_uri_by_resource(resource) for module, resource in self.module_resource.items()}
+        self.uri_module        = {uri: module for module, uri in self.module_uri.items()}
         self.process_flag      = True
-        self._http_server_process = None
-        self._http_server_port_pipe = os.pipe()
+        # Without a terminal the progress bar is only redrawn when the percent changes
+        self._progress_tty     = sys.stdout.isatty()
+        self._last_percent     = None
         self._local_http_server_port = None
         self.use_curl          = use_curl
         self.http_accessor     = self._get_http_accessor()
+        self.session           = session if session is not None else get_http_session(self.bmc_ip, self.bmc_port, self.username, self.use_curl)
         self.bfb_update_protocol = bfb_update_protocol
         self.info_data         = None
+        # Members of info_data by name
+        self._info_by_name     = {}
         self.reset_bios        = reset_bios
         self.lfwp              = lfwp
         self.version           = version
+        self._update_service   = None
+        self._local_ip         = None
+        self._http_server      = None
+        # Whether BMC expands the members ($expand) of the task list and of the
+        # firmware inventory; None until known, BMC may support it on one only
+        self._supports_task_expand      = None
+        self._supports_inventory_expand = None
+        # url -> [ETag, response, parsed body] of the resources polled with _http_get_conditional()
+        self._etag_cache       = {}
 
         # Validate log_file if provided
         if self.log_file is not None:
@@ -75,26 +264,27 @@ class BF_DPU_Update(object):
             if not accessible_file and not accessible_dir:
                 raise Err_Exception(Err_Num.FILE_NOT_ACCESSIBLE, 'Log file: {}'.format(self.log_file))
 
-            with open(self.log_file, 'a') as f:
-                f.write('OobUpdate Version: {}\n'.format(self.version))
+            self._log_fh = _get_log_file(self.log_file)
+            with _log_file_lock:
+                self._log_fh.write('OobUpdate Version: {}\n'.format(self.version))
 
 
     def _get_prot_ip_port(self):
-        port = '' if self.bmc_port is None else ':{}'.format(self.bmc_port)
-        return self.protocol + self._format_ip(self.bmc_ip) + port
+        return self._prot_ip_port
 
 
     def _get_url_base(self):
-        return self._get_prot_ip_port() + self.redfish_root
+        return self._url_base
 
 
     def _get_local_ip(self):
-        if self._is_ipv4:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        else:
-            s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
-        s.connect((self.bmc_ip, 0))
-        return s.getsockname()[0]
+        # The address of the route to BMC does not change during the update, look it up once
+        if self._local_ip is None:
+            family = socket.AF_INET if self._is_ipv4 else socket.AF_INET6
+            with socket.socket(family, socket.SOCK_DGRAM) as s:
+                s.connect((self.bmc_ip, 0))
+                self._local_ip = s.getsockname()[0]
+        return self._local_ip
 
 
     def _get_local_user(self):
@@ -110,25 +300,71 @@ class BF_DPU_Update(object):
 
 
     def _http_get(self, url, headers=None, timeout=(60, 60)):
-        return self.http_accessor(url, 'GET', self.username, self.password, self.task_dir, headers, timeout).access()
+        return self.http_accessor(url, 'GET', self.username, self.password, self.task_dir, headers, timeout, session=self.session).access()
 
 
-    def _http_post(self, url, data, headers=None, timeout=(120, 120)):
-        return self.http_accessor(url, 'POST', self.username, self.password, self.task_dir, headers, timeout).access(data)
+    # json_data: object sent as JSON body, serialized (and typed) by the accessor
+    def _http_post(self, url, data=None, headers=None, timeout=(120, 120), json_data=None):
+        return self.http_accessor(url, 'POST', self.username, self.password, self.task_dir, headers, timeout, session=self.session).access(data, json_data=json_data)
 
 
-    def _http_patch(self, url, data, headers=None, timeout=(60, 60)):
-        return self.http_accessor(url, 'PATCH', self.username, self.password, self.task_dir, headers, timeout).access(data)
+    def _http_patch(self, url, data=None, headers=None, timeout=(60, 60), json_data=None):
+        return self.http_accessor(url, 'PATCH', self.username, self.password, self.task_dir, headers, timeout, session=self.session).access(data, json_data=json_data)
 
-    def _http_put(self, url, data, headers=None, timeout=(60, 60)):
-        return self.http_accessor(url, 'PUT', self.username, self.password, self.task_dir, headers, timeout).access(data)
+    def _http_put(self, url, data=None, headers=None, timeout=(60, 60), json_data=None):
+        return self.http_accessor(url, 'PUT', self.username, self.password, self.task_dir, headers, timeout, session=self.session).access(data, json_data=json_data)
 
     def _upload_file(self, url, file_path, headers=None, timeout=(60, 60)):
-        return self.http_accessor(url, 'POST', self.username, self.password, self.task_dir, headers, timeout).upload_file(file_path)
+        return self.http_accessor(url, 'POST', self.username, self.password, self.task_dir, headers, timeout, session=self.session).upload_file(file_path)
 
 
     def _multi_part_push(self, url, param, headers=None, timeout=(60, 60)):
-        return self.http_accessor(url, 'POST', self.username, self.password, self.task_dir, headers, timeout).multi_part_push(param)
+        return self.http_accessor(url, 'POST', self.username, self.password, self.task_dir, headers, timeout, session=self.session).multi_part_push(param)
+
+
+    def _http_get_conditional(self, url, log_msg):
+        '''
+        GET a resource polled in a loop with If-None-Match, so that BMC can answer
+        304 Not Modified while it does not change; the response last received with
+        a body is returned in that case. The response actually received is logged
+        with log_msg.
+        '''
+        # Entries are [etag, response, parsed body or None]
+        cached  = self._etag_cache.get(url)
+        headers = None if cached is None else {'If-None-Match': cached[0]}
+        response = self._http_get(url, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            self.log('{} (not modified, cached body reused)'.format(log_msg), response)
+            return cached[1]
+        self.log(log_msg, response)
+        etag = self._get_response_header(response, 'ETag') if response.status_code == 200 else None
+        if etag:
+            self._etag_cache[url] = [etag, response, None]
+        else:
+            self._etag_cache.pop(url, None)
+        return response
+
+
+    def _get_conditional_json(self, url, response):
+        # Parse a response of _http_get_conditional once per ETag, not once per poll
+        cached = self._etag_cache.get(url)
+        if cached is None or cached[1] is not response:
+            return response.json()
+        if cached[2] is None:
+            cached[2] = response.json()
+        return cached[2]
+
+
+    @staticmethod
+    def _get_response_header(response, name):
+        # requests gives a header dict, curl the raw header lines
+        if hasattr(response.headers, 'get'):
+            return response.headers.get(name)
+        for line in str(response.headers).splitlines():
+            key, sep, value = line.partition(':')
+            if sep and key.strip().lower() == name.lower():
+                return value.strip()
+        return None
 
 
     def _get_truncated_data(self, data):
@@ -151,17 +387,12 @@ class BF_DPU_Update(object):
             self._is_ipv4 = False
             return address
 
-        # Host name(ipv4) ?
-        ipv4 = self._get_ipv4_from_name(address)
-        if ipv4 is not None:
-            self._is_ipv4 = True
-            return ipv4
-
-        # Host name(ipv6) ?
-        ipv6 = self._get_ipv6_from_name(address)
-        if ipv6 is not None:
-            self._is_ipv4 = False
-            return ipv6
+        # Host name ?
+        resolved = self._resolve_name(address)
+        if resolved is not None:
+            family, ip = resolved
+            self._is_ipv4 = family == socket.AF_INET
+            return ip
         raise Err_Exception(Err_Num.INVALID_BMC_ADDRESS, '{} is neither a valid IPV4/IPV6 nor a resolvable host name'.format(address))
 
 
@@ -170,7 +401,7 @@ class BF_DPU_Update(object):
         try:
             socket.inet_pton(socket.AF_INET, address)
             return True
-        except:
+        except (OSError, ValueError):
             return False
 
 
@@ -179,26 +410,25 @@ class BF_DPU_Update(object):
         try:
             socket.inet_pton(socket.AF_INET6, address)
             return True
-        except:
+        except (OSError, ValueError):
             return False
 
 
     @staticmethod
-    def _get_ipv4_from_name(address):
-        try:
-            ipv4_list = socket.getaddrinfo(address, None, socket.AF_INET)
-            return ipv4_list[0][4][0]
-        except:
-            return None
-
-
-    @staticmethod
-    def _get_ipv6_from_name(address):
+    def _resolve_name(address):
+        '''
+        Resolve host name address with a single lookup for both families.
+        Return (family, ip), IPV4 preferred, or None if it does not resolve
+        '''
         try:
-            ipv6_list = socket.getaddrinfo(address, None, socket.AF_INET6)
-            return ipv6_list[0][4][0]
-        except:
+            addr_list = socket.getaddrinfo(address, None, socket.AF_UNSPEC, socket.SOCK_STREAM)
+        except socket.gaierror:
             return None
+        for family in (socket.AF_INET, socket.AF_INET6):
+            for addr in addr_list:
+                if addr[0] == family:
+                    return (family, addr[4][0])
+        return None
 
 
     def _format_ip(self, ip):
@@ -221,6 +451,11 @@ class BF_DPU_Update(object):
         Raises:
             Err_Exception: If BMC is not reachable with specific error details
         """
+        with _bmc_available_lock:
+            checked = _bmc_available.get((self.bmc_ip, self.bmc_port))
+        if checked is not None and time.monotonic() - checked < BMC_AVAILABLE_TTL:
+            return True
+
         try:
             self.log("Checking BMC availability at {}".format(self._format_ip(self.bmc_ip)))
 
@@ -231,6 +466,8 @@ class BF_DPU_Update(object):
             # Check if we get a valid response
             if response.status_code in [200, 401]:  # 200 = OK, 401 = Unauthorized but BMC is reachable
                 self.log("BMC is available and responding")
+                with _bmc_available_lock:
+                    _bmc_available[(self.bmc_ip, self.bmc_port)] = time.monotonic()
                 return True
             else:
                 self.log("BMC responded with unexpected status code: {}".format(response.status_code))
@@ -254,7 +491,16 @@ class BF_DPU_Update(object):
                 raise Err_Exception(Err_Num.BMC_CONNECTION_FAIL, "Failed to connect to BMC at {}. Please verify the IP address and network connectivity".format(self._format_ip(self.bmc_ip)))
 
 
+    def _forget_bmc_available(self):
+        # BMC (or the system) is about to reset, check it again next time
+        with _bmc_available_lock:
+            _bmc_available.pop((self.bmc_ip, self.bmc_port), None)
+
+
     def _validate_fru_date_format(self, date_str):
+        # The regex turns malformed strings down, strptime then checks the date is real
+        if not _FRU_DATE_RE.match(date_str):
+            return False
         try:
             datetime.datetime.strptime(date_str, "%d/%m/%Y %H:%M:%S")
             return True
@@ -278,18 +524,22 @@ class BF_DPU_Update(object):
             data += "[Response Body]:" + '\n'
             data += resp.text + '\n'
 
-        data = data.replace(self.password, '<password>')
-        data = data.replace(self.username, '<username>')
-        if self.ssh_password is not None and self.ssh_password != '':
-            data = data.replace(self.ssh_password, '<ssh_password>')
-        if self.ssh_username is not None and self.ssh_username != '':
-            data = data.replace(self.ssh_username, '<ssh_username>')
+        if self._redact_re is not None:
+            data = self._redact_re.sub(lambda m: self._redact_map[m.group(0)], data)
 
         if self.debug:
             print(data, end='')
         if self.log_file is not None:
-            with open(self.log_file, 'a') as f:
-                f.write(data)
+            with _log_file_lock:
+                self._log_fh.write(data)
+
+
+    def flush_log(self):
+        # The log file is buffered: write it out at the end of each task and phase,
+        # so that it is up to date while the run goes on
+        if self.log_file is not None:
+            with _log_file_lock:
+                self._log_fh.flush()
 
 
     def _handle_status_code(self, response, acceptable_codes, err_handler=None):
@@ -297,11 +547,15 @@ class BF_DPU_Update(object):
             return
 
         try:
-            msg = response.json()['error']['message']
-        except:
+            body = response.json()
+        except _RESPONSE_FORMAT_ERRORS:
+            body = None
+        try:
+            msg = body['error']['message']
+        except _RESPONSE_FORMAT_ERRORS:
             try:
-                msg = response.json()['Attributes@Message.ExtendedInfo'][0]['Message']
-            except:
+                msg = body['Attributes@Message.ExtendedInfo'][0]['Message']
+            except _RESPONSE_FORMAT_ERRORS:
                 msg = ''
 
         # Raise exception for different cases
@@ -320,32 +574,65 @@ class BF_DPU_Update(object):
     def get_ver_by_uri(self, uri):
         url = self._get_prot_ip_port() + uri
         response = self._http_get(url)
-        self.log('Get {} Firmware Version'.format(uri.split('/')[-1]), response)
+        self.log('Get {} Firmware Version'.format(uri.rpartition('/')[2]), response)
         self._handle_status_code(response, [200])
 
         ver = ''
         try:
             ver = response.json()['Version']
-        except Exception as e:
+        except _RESPONSE_FORMAT_ERRORS:
             raise Err_Exception(Err_Num.BAD_RESPONSE_FORMAT, 'Failed to extract firmware version')
 
         return ver
 
 
     def _get_ver(self, module):
-        return self.get_ver_by_uri(self._get_firmware_uri_by_resource(self.module_resource[module]))
+        return self.get_ver_by_uri(self.module_uri[module])
 
 
     def get_ver(self, module, num_of_tries=3):
-        for i in range(num_of_tries):
+        # Retry up to a deadline rather than a count of tries: the backoff tries
+        # sooner first, without shortening the total wait
+        deadline = time.monotonic() + (num_of_tries - 1) * GET_VER_RETRY_SECONDS
+        backoff  = _backoff_iter()
+        while True:
             try:
                 ver = self._get_ver(module)
                 return ver
             except Exception as e:
                 if self.debug:
                     print("Exception when get version: {}".format(e))
-            time.sleep(4)
-        return ''
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return ''
+            time.sleep(min(next(backoff), remaining))
+
+
+    def get_fw_digest(self):
+        '''
+        Return the SHA-256 digest of the firmware package currently running for
+        self.module, or None if BMC does not report it.
+        {
+            ...
+            "Oem": {
+                "Nvidia": {
+                    "PackageDigest": "<sha256>"
+                }
+            }
+        }
+        '''
+        if self.module not in self.digest_module:
+            return None
+        uri = self.module_uri[self.digest_module[self.module]]
+        response = self._http_get(self._get_prot_ip_port() + uri)
+        self.log('Get {} Firmware Digest'.format(self.module), response)
+        # Only an optimization: any other reply (e.g. 404 on older BMC firmware) means unknown
+        if response.status_code != 200:
+            return None
+        try:
+            return response.json()['Oem']['Nvidia']['PackageDigest'].lower()
+        except _RESPONSE_FORMAT_ERRORS:
+            return None
 
 
     def _extract_task_handle(self, response):
@@ -360,15 +647,29 @@ class BF_DPU_Update(object):
         '''
         try:
             return response.json()["@odata.id"]
-        except:
+        except _RESPONSE_FORMAT_ERRORS:
             raise Err_Exception(Err_Num.BAD_RESPONSE_FORMAT, 'Failed to extract task handle')
 
 
+    def _get_update_service(self, force=False):
+        '''
+        Return the UpdateService resource. It is fetched once and kept: the protocols
+        and push URIs it lists do not change; force fetches it again, for its state
+        '''
+        if force or self._update_service is None:
+            url = self._get_url_base() + '/UpdateService'
+            response = self._http_get(url)
+            self.log('Get UpdateService Attribute', response)
+            self._handle_status_code(response, [200])
+            try:
+                self._update_service = response.json()
+            except _RESPONSE_FORMAT_ERRORS:
+                return {}
+        return self._update_service
+
+
     def get_simple_update_protocols(self):
-        url = self._get_url_base() + '/UpdateService'
-        response = self._http_get(url)
-        self.log('Get UpdateService Attribute', response)
-        self._handle_status_code(response, [200])
+        update_service = self._get_update_service()
 
         protocols = []
         '''
@@ -387,20 +688,15 @@ class BF_DPU_Update(object):
         }
         '''
         try:
-            protocols = response.json()['Actions']['#UpdateService.SimpleUpdate']['TransferProtocol@Redfish.AllowableValues']
-        except Exception as e:
+            protocols = update_service['Actions']['#UpdateService.SimpleUpdate']['TransferProtocol@Redfish.AllowableValues']
+        except _RESPONSE_FORMAT_ERRORS:
             raise Err_Exception(Err_Num.BAD_RESPONSE_FORMAT, 'Failed to extract SimpleUpdate protocols')
         return protocols
 
 
     def get_push_uri(self):
-        url = self._get_url_base() + '/UpdateService'
-        response = self._http_get(url)
-        self.log('Get UpdateService Attribute', response)
-        self._handle_status_code(response, [200])
+        update_service = self._get_update_service()
 
-        deprecated_uri = None
-        multi_part_uri = None
         '''
         {
           ...
@@ -409,22 +705,14 @@ class BF_DPU_Update(object):
           ...
         }
         '''
-        try:
-            deprecated_uri = response.json()['HttpPushUri']
-        except:
-            deprecated_uri = None
-        try:
-            multi_part_uri = response.json()['MultipartHttpPushUri']
-        except:
-            multi_part_uri = None
+        deprecated_uri = update_service.get('HttpPushUri')
+        multi_part_uri = update_service.get('MultipartHttpPushUri')
         return (multi_part_uri, deprecated_uri)
 
 
     def get_update_service_state(self):
-        url = self._get_url_base() + '/UpdateService'
-        response = self._http_get(url)
-        self.log('Get UpdateService state', response)
-        self._handle_status_code(response, [200])
+        # The state changes, always fetch it; the response is kept for the other getters
+        update_service = self._get_update_service(force=True)
 
         state = ''
         '''
@@ -437,8 +725,8 @@ class BF_DPU_Update(object):
         }
         '''
         try:
-            state = response.json()['Status']['State']
-        except Exception as e:
+            state = update_service['Status']['State']
+        except _RESPONSE_FORMAT_ERRORS:
             raise Err_Exception(Err_Num.BAD_RESPONSE_FORMAT, 'Failed to extract update service state')
         return state
 
@@ -449,10 +737,11 @@ class BF_DPU_Update(object):
 
         print("Wait for update service ready")
         timeout = 60 * 3 # Wait up to 3 minutes
-        start   = int(time.time())
+        start   = time.monotonic()
         end     = start + timeout
+        backoff = _backoff_iter()
         while True:
-            cur = int(time.time())
+            cur = time.monotonic()
             if cur > end:
                 raise Err_Exception(Err_Num.UPDATE_SERVICE_NOT_READY)
             try:
@@ -464,7 +753,7 @@ class BF_DPU_Update(object):
                     self._print_process(100 * (cur - start) / timeout)
             except Exception as e:
                 self._print_process(100 * (cur - start) / timeout)
-            time.sleep(4)
+            time.sleep(next(backoff))
         print()
 
 
@@ -472,7 +761,7 @@ class BF_DPU_Update(object):
     def _update_in_progress_err_handler(response):
         try:
             msg = response.json()['error']['message']
-        except:
+        except _RESPONSE_FORMAT_ERRORS:
             msg = ''
 
         if response.status_code == 400:
@@ -526,35 +815,52 @@ class BF_DPU_Update(object):
 
     def simple_update_impl(self, protocol, image_uri):
         url = self._get_url_base() + '/UpdateService/Actions/UpdateService.SimpleUpdate'
-        headers = {
-            'Content-Type'     : 'application/json'
-        }
         data = {
             'TransferProtocol' : protocol,
             'ImageURI'         : image_uri,
             'Targets'          : self.get_simple_update_targets(),
             'Username'         : self._get_local_user()
         }
-        response = self._http_post(url, data=json.dumps(data), headers=headers)
+        response = self._http_post(url, json_data=data)
         self.log('Do Simple Update (Update BFB or Configurations ...)', response)
         self._handle_status_code(response, [100, 200, 202], self._update_in_progress_err_handler)
         return self._extract_task_handle(response)
 
 
+    def _merge_cfg_file(self):
+        # SCP needs a real file: append the cfg file to a copy of the firmware file
+        import shutil
+        merged_path = os.path.join(self.task_dir, 'merged_' + os.path.basename(self.fw_file_path))
+        with open(self.fw_file_path, 'rb') as f1, open(self.cfg_file, 'rb') as f2, open(merged_path, 'wb') as out:
+            shutil.copyfileobj(f1, out, 1 << 20)
+            shutil.copyfileobj(f2, out)
+        self.fw_file_path = merged_path
+        self.cfg_file     = None
+
+
     def simple_update_by_scp(self):
+        if self.cfg_file is not None:
+            self._merge_cfg_file()
         self.confirm_ssh_key_with_bmc()
         print("Start to do Simple Update (SCP)")
         return self.simple_update_impl('SCP', self._format_ip(self._get_local_ip()) + '/' + os.path.abspath(self.fw_file_path))
 
 
     def run_command_on_bmc(self, command, exit_on_error=True):
+        # command is an argv list (see _bmc_ssh_argv) or a command line string
+        argv    = shlex.split(command) if isinstance(command, str) else command
+        command = command if isinstance(command, str) else shlex.join(command)
         self.log("Run command on BMC: {}".format(command))
         rc, output = (0, '')
         try:
-            output = subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True, universal_newlines=True)
+            # Run sshpass/ssh directly, without a shell in between
+            output = subprocess.check_output(argv, stderr=subprocess.STDOUT, universal_newlines=True)
         except subprocess.CalledProcessError as e:
             rc = e.returncode
             output = e.output.strip()
+        except OSError as e:
+            rc = 127
+            output = str(e)
         self.log('Output: {}\nError: {}'.format(output, rc))
         if rc != 0:
             if not exit_on_error:
@@ -565,56 +871,74 @@ class BF_DPU_Update(object):
 
 
     def http_server(self):
+        '''
+        Serve the firmware file over HTTP from a daemon thread.
+        Return the port the server listens on.
+        '''
         debug = self.debug
-        from http.server import HTTPServer, SimpleHTTPRequestHandler
+        from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+        # With a cfg file, the firmware file followed by the cfg file is served as
+        # one file, so the merged file never needs to be written to disk
+        merged_name  = os.path.basename(self.fw_file_path)
+        merged_files = None if self.cfg_file is None else [os.path.abspath(self.fw_file_path), os.path.abspath(self.cfg_file)]
         class _SimpleHTTPRequestHandler(SimpleHTTPRequestHandler):
             def log_message(self, format, *args):
                 if debug:
                     super().log_message(format, *args)
 
+            def _send_merged_head(self):
+                if os.path.basename(self.path) != merged_name:
+                    self.send_error(404)
+                    return False
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(sum(os.path.getsize(f) for f in merged_files)))
+                self.end_headers()
+                return True
+
+            def do_HEAD(self):
+                if merged_files is None:
+                    return super().do_HEAD()
+                self._send_merged_head()
+
+            def do_GET(self):
+                if merged_files is None:
+                    return super().do_GET()
+                if not self._send_merged_head():
+                    return
+                for file_path in merged_files:
+                    with open(file_path, 'rb') as f:
+                        self.connection.sendfile(f)
+
+        # Serve from the firmware directory without changing the process working directory
         abs_dir = os.path.dirname(os.path.abspath(self.fw_file_path))
-        os.chdir(abs_dir)
+        handler = functools.partial(_SimpleHTTPRequestHandler, directory=abs_dir)
         if self._is_ipv4:
-            _HTTPServer = HTTPServer
+            _HTTPServer = ThreadingHTTPServer
         else:
-            class HTTPServerV6(HTTPServer):
+            class HTTPServerV6(ThreadingHTTPServer):
                 address_family = socket.AF_INET6
             _HTTPServer = HTTPServerV6
 
-        httpd = _HTTPServer((self._get_local_ip(), 0), _SimpleHTTPRequestHandler)
-        port = httpd.server_address[1]
-        write_fd = self._http_server_port_pipe[1]
-        os.write(write_fd, bytes(str(port), 'utf-8'))
-        httpd.serve_forever()
-
-
-    def create_http_server_thread(self):
-        import threading
-        thread = threading.Thread(target=self.http_server, daemon=True)
-        thread.start()
-
+        try:
+            httpd = _HTTPServer((self._get_local_ip(), 0), handler)
+        except OSError as e:
+            raise Err_Exception(Err_Num.FAILED_TO_START_HTTP_SERVER, str(e))
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        self._http_server = httpd
+        return httpd.server_address[1]
 
-    def create_http_server_process(self):
-        self._http_server_process = Process(target=self.http_server)
-        self._http_server_process.daemon = True
-        self._http_server_process.start()
 
-
-    def read_http_server_port(self):
-        read_fd = self._http_server_port_pipe[0]
-        timeout = 60 # Seconds
-        ready_to_read, _, _ = select.select([read_fd], [], [], timeout)
-        if read_fd in ready_to_read:
-            data = os.read(read_fd, 1024)
-            port = int(data)
-            return port
-        else:
-            raise Err_Exception(Err_Num.FAILED_TO_START_HTTP_SERVER)
+    def stop_http_server(self):
+        # Stop the server thread and release the listening socket
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+            self._http_server = None
 
 
     def simple_update_by_http(self):
-        self.create_http_server_process()
-        self._local_http_server_port = self.read_http_server_port()
+        self._local_http_server_port = self.http_server()
         print("Start to do Simple Update (HTTP)")
         return self.simple_update_impl('HTTP', self._format_ip(self._get_local_ip()) + ':' + str(self._local_http_server_port) + '//' + os.path.basename(self.fw_file_path))
 
@@ -679,46 +1003,41 @@ class BF_DPU_Update(object):
         }
         '''
         try:
-            percent = response.json()['PercentComplete']
-            state   = response.json()['TaskState']
-            status  = response.json()['TaskStatus']
-            message = response.json()['Messages']
-            payload = response.json()['Payload']
-            return {'state': state, 'status': status, 'percent': percent, 'message': str(message), 'payload': payload}
-        except:
+            return self._parse_task_state(response.json())
+        except _RESPONSE_FORMAT_ERRORS:
             raise Err_Exception(Err_Num.BAD_RESPONSE_FORMAT, 'Failed to extract task status')
 
 
+    @staticmethod
+    def _parse_task_state(body):
+        percent = body['PercentComplete']
+        state   = body['TaskState']
+        status  = body['TaskStatus']
+        message = body['Messages']
+        payload = body['Payload']
+        return {'state': state, 'status': status, 'percent': percent, 'message': str(message), 'payload': payload}
+
+
     def reboot_bmc(self):
         print("Restart BMC to make new firmware take effect")
+        self._forget_bmc_available()
         url = self._get_url_base() + '/Managers/Bluefield_BMC/Actions/Manager.Reset'
-        headers = {
-            'Content-Type' : 'application/octet-stream'
-        }
-        data = {
-            'ResetType' : 'GracefulRestart'
-        }
-        response = self._http_post(url, data=json.dumps(data), headers=headers)
+        response = self._http_post(url, data=self._RESET_GRACEFUL_BODY, headers=self._OCTET_HEADERS)
         self.log('Reboot BMC', response)
         self._handle_status_code(response, [200])
         self._wait_for_bmc_on()
 
 
     def reboot_cec(self):
+        self._forget_bmc_available()
         url = self._get_url_base() + '/Chassis/Bluefield_ERoT/Actions/Chassis.Reset'
-        headers = {
-            'Content-Type' : 'application/json'
-        }
-        data = {
-            'ResetType' : 'GracefulRestart'
-        }
-        response = self._http_post(url, data=json.dumps(data), headers=headers)
+        response = self._http_post(url, data=self._RESET_GRACEFUL_BODY, headers=self._JSON_HEADERS)
         self.log('Reboot CEC', response)
 
         def err_handler(response):
             try:
                 code = response.json()['error']['code']
-            except:
+            except _RESPONSE_FORMAT_ERRORS:
                 code = ''
             if 'ActionNotSupported' in code:
                 raise Err_Exception(Err_Num.NOT_SUPPORT_CEC_RESTART, 'Please use power cycle of the whole system instead')
@@ -743,24 +1062,31 @@ class BF_DPU_Update(object):
 
     def _wait_for_bmc_on(self, show_progress=True):
         timeout = 60 * 3 # Wait up to 3 minutes
-        start   = int(time.time())
+        start   = time.monotonic()
         end     = start + timeout
-        while True:
-            cur = int(time.time())
-            if cur > end:
-                if show_progress:
-                    self._print_process(100)
-                break
-            time.sleep(4)
-            try:
-                self._get_ver('BMC')
-                self._get_ver('CEC')
-                if show_progress:
-                    self._print_process(100)
-                break
-            except Exception as e:
-                if show_progress:
-                    self._print_process(100 * (cur - start) / timeout)
+        # The first probe waits 4 seconds, so that a rebooting BMC is seen going down
+        time.sleep(4)
+        backoff = _backoff_iter()
+        # BMC and CEC versions are probed at the same time, BMC is on when both answer
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            while True:
+                cur = time.monotonic()
+                if cur > end:
+                    if show_progress:
+                        self._print_process(100)
+                    break
+                try:
+                    probes = [executor.submit(self._get_ver, module) for module in ('BMC', 'CEC')]
+                    wait(probes)
+                    for probe in probes:
+                        probe.result()
+                    if show_progress:
+                        self._print_process(100)
+                    break
+                except Exception as e:
+                    if show_progress:
+                        self._print_process(100 * (cur - start) / timeout)
+                time.sleep(next(backoff))
         if show_progress:
             print()
 
@@ -772,22 +1098,17 @@ class BF_DPU_Update(object):
         """
         if not version_str or not isinstance(version_str, str):
             return (0, 0, 0)
+        return self._bmc_ver_key(version_str)
 
-        # Remove BF- prefix if present
-        version = version_str.replace('BF-', '')
 
-        try:
-            # Split by dots and dashes to get version components
-            parts = version.replace('-', '.').split('.')
-            if len(parts) >= 3:
-                major = int(parts[0])
-                minor = int(parts[1])
-                patch = int(parts[2])
-                return (major, minor, patch)
-        except (ValueError, IndexError):
-            pass
-
-        return (0, 0, 0)
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def _bmc_ver_key(version_str):
+        # Versions are compared against the same threshold again and again, keep the keys
+        m = BF_DPU_Update._VER_RE.match(version_str)
+        if m is None:
+            return (0, 0, 0)
+        return (int(m.group(1)), int(m.group(2)), int(m.group(3)))
 
 
     def _compare_bmc_versions(self, version1, version2):
@@ -800,26 +1121,16 @@ class BF_DPU_Update(object):
         """
         v1_tuple = self._parse_bmc_version(version1)
         v2_tuple = self._parse_bmc_version(version2)
-
-        if v1_tuple < v2_tuple:
-            return -1
-        elif v1_tuple > v2_tuple:
-            return 1
-        else:
-            return 0
+        return (v1_tuple > v2_tuple) - (v1_tuple < v2_tuple)
 
 
     def clear_sel_log(self):
         """Clear the System Event Log (SEL) on BMC"""
         print("Clearing BMC SEL log")
         url = self._get_url_base() + '/Systems/Bluefield/LogServices/EventLog/Actions/LogService.ClearLog'
-        headers = {
-            'Content-Type': 'application/json'
-        }
-        data = {}
 
         try:
-            response = self._http_post(url, data=json.dumps(data), headers=headers)
+            response = self._http_post(url, data=self._EMPTY_JSON_BODY, headers=self._JSON_HEADERS)
             self.log('Clear BMC SEL log', response)
             self._handle_status_code(response, [200, 204])
             print("BMC SEL log cleared successfully")
@@ -854,52 +1165,84 @@ class BF_DPU_Update(object):
 
     def factory_reset_bmc(self):
         print("Factory reset BMC configuration")
+        self._forget_bmc_available()
         url = self._get_url_base() + '/Managers/Bluefield_BMC/Actions/Manager.ResetToDefaults'
-        headers = {
-            'Content-Type' : 'application/json'
-        }
-        data = {
-            'ResetToDefaultsType' : 'ResetAll'
-        }
-        response = self._http_post(url, data=json.dumps(data), headers=headers)
+        response = self._http_post(url, data=self._RESET_TO_ALL_BODY, headers=self._JSON_HEADERS)
         self.log('Factory Reset BMC', response)
         self._handle_status_code(response, [200])
         self._wait_for_bmc_on()
 
 
+    def _bmc_ssh_argv(self, remote_command=None, ssh_options=(), with_password=True):
+        '''
+        Command line of ssh to BMC as an argv list, to be run without a shell
+        '''
+        argv = ['sshpass', '-p', self.ssh_password] if with_password else []
+        argv += shlex.split(self.ssh) + list(ssh_options) + ['{}@{}'.format(self.ssh_username, self.bmc_ip)]
+        if remote_command is not None:
+            argv.append(remote_command)
+        return argv
+
+
+    def start_ssh_mux(self):
+        '''
+        Start a background SSH master connection to BMC, which is reused by the
+        later ssh commands on BMC, so they skip the connection setup and key exchange.
+        Return True if the master connection is up.
+        '''
+        if not self.ssh_mux or not self.ssh_username or not self.ssh_password:
+            return False
+        command = self._bmc_ssh_argv(ssh_options=('-MNf', '-o', 'ControlMaster=yes', '-o', 'ControlPersist=2h'))
+        try:
+            process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60)
+        except subprocess.TimeoutExpired:
+            return False
+        self.log('Start SSH master connection to BMC, return code {}'.format(process.returncode))
+        if process.returncode != 0:
+            return False
+        self.ssh_mux_started = True
+        return True
+
+
+    def ensure_ssh_mux(self):
+        '''
+        Make sure the SSH master connection is up before a series of commands on
+        BMC: it is gone once BMC has rebooted, start it again in that case
+        '''
+        if not self.ssh_mux:
+            return False
+        command = self._bmc_ssh_argv(ssh_options=('-O', 'check'), with_password=False)
+        if subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+            return True
+        return self.start_ssh_mux()
+
+
+    def stop_ssh_mux(self):
+        '''
+        Stop the SSH master connection to BMC, if it was started by this object
+        '''
+        if not self.ssh_mux or not self.ssh_mux_started:
+            return
+        self.ssh_mux_started = False
+        command = self._bmc_ssh_argv(ssh_options=('-O', 'exit'), with_password=False)
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
     def _set_bmc_rshim_display_level(self, value):
-        self.run_command_on_bmc("sshpass -p {password} {ssh} {username}@{ip} '{command}'".format(
-            ssh=self.ssh,
-            password=self.ssh_password,
-            username=self.ssh_username,
-            ip=self.bmc_ip,
-            command='/bin/bash -c "echo DISPLAY_LEVEL {value} > /dev/rshim0/misc"'.format(value=value),
-            exit_on_error=False
-        ))
+        self.run_command_on_bmc(self._bmc_ssh_argv('/bin/bash -c "echo DISPLAY_LEVEL {} > /dev/rshim0/misc"'.format(value)),
+                                exit_on_error=False)
 
 
     def get_bmc_rshim_misc(self):
-        misc = self.run_command_on_bmc("sshpass -p {password} {ssh} {username}@{ip} '{command}'".format(
-            ssh=self.ssh,
-            password=self.ssh_password,
-            username=self.ssh_username,
-            ip=self.bmc_ip,
-            command='/bin/bash -c "cat /dev/rshim0/misc"',
-            exit_on_error=False
-        ))
+        misc = self.run_command_on_bmc(self._bmc_ssh_argv('/bin/bash -c "cat /dev/rshim0/misc"'),
+                                       exit_on_error=False)
         return misc
 
     def query_golden_image_config_dir_exists_on_bmc(self):
         out = None
         try:
-            out = self.run_command_on_bmc("sshpass -p {password} {ssh} {username}@{ip} '{command}'".format(
-                ssh=self.ssh,
-                password=self.ssh_password,
-                username=self.ssh_username,
-                ip=self.bmc_ip,
-                command='/bin/bash -c "[ -d /tmp/golden-image-config ] && echo YES || echo NO"',
-                exit_on_error=False
-            ))
+            out = self.run_command_on_bmc(self._bmc_ssh_argv('/bin/bash -c "[ -d /tmp/golden-image-config ] && echo YES || echo NO"'),
+                                          exit_on_error=False)
         except Exception as e:
             print("Query BMC Config DIR failed: {0}".format(str(e)))
             return False
@@ -942,6 +1285,10 @@ class BF_DPU_Update(object):
         return False
 
     def _print_process(self, percent):
+        if not self._progress_tty:
+            if int(percent) == self._last_percent:
+                return
+            self._last_percent = int(percent)
         print('\r', end='')
         flag = '|' if self.process_flag else '-'
         self.process_flag = not self.process_flag
@@ -949,9 +1296,16 @@ class BF_DPU_Update(object):
 
 
     def _sleep_with_process_with_percent(self, sec, start_percent=0, end_percent=100):
-        for i in range(1, sec+1):
-            time.sleep(1)
-            self._print_process(start_percent + ((i * (end_percent - start_percent)) // sec))
+        # Sleep until a monotonic deadline, so the time spent printing does not add up;
+        # the progress bar is redrawn once a second
+        start = time.monotonic()
+        end   = start + sec
+        now   = start
+        while now < end:
+            time.sleep(min(1, end - now))
+            now = time.monotonic()
+            elapsed = min(now - start, sec)
+            self._print_process(start_percent + int(elapsed * (end_percent - start_percent)) // sec)
 
 
     def _sleep_with_process(self, sec):
@@ -961,76 +1315,129 @@ class BF_DPU_Update(object):
 
     def _extract_ver_from_fw_file(self, pattern):
         file_name = os.path.basename(self.fw_file_path)
-        match     = re.search(pattern, file_name)
+        match     = pattern.search(file_name)
         substring = match.group(0)
         return substring
 
 
     def extract_cec_ver_from_fw_file(self):
-        return self._extract_ver_from_fw_file(r'\d\d.\d\d.\d\d\d\d.\d\d\d\d')
+        return self._extract_ver_from_fw_file(_CEC_VER_RE)
 
 
     def extract_bmc_ver_from_fw_file(self):
-        return self._extract_ver_from_fw_file(r'\d\d.\d\d-\d')
+        return self._extract_ver_from_fw_file(_BMC_VER_RE)
 
 
-    def extract_atf_uefi_ver_from_fw_file(self):
-        command = r'strings {} | grep -m 1 "(\(release\|debug\))"'.format(self.fw_file_path)
-        process   = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = process.communicate()
-        if process.returncode != 0:
-            raise Err_Exception(Err_Num.FAILED_TO_GET_VER_FROM_FILE, 'Command "{}" failed with return code {}'.format(command, process.returncode))
+    def _scan_fw_file_markers(self):
+        '''
+        Scan the firmware file once for the markers of all firmware types.
+        Return a dict: marker -> found, and 'atf_ver' -> the first printable
+        string holding an ATF/UEFI version marker, or None.
+        '''
+        markers = dict.fromkeys(_FW_TYPE_MARKERS, False)
+        markers['atf_ver'] = None
+        if not self.fw_file_path:
+            return markers
+        try:
+            with open(self.fw_file_path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                # The same file is checked by all objects of the run (update, config,
+                # every BMC), scan it once until it is changed
+                key = (os.path.realpath(self.fw_file_path), st.st_size, st.st_mtime_ns)
+                with _fw_markers_lock:
+                    if key in _fw_markers_cache:
+                        return _fw_markers_cache[key]
+                if st.st_size:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        self._scan_fw_markers_in(mm, st.st_size, markers)
+            with _fw_markers_lock:
+                _fw_markers_cache[key] = markers
+        except (OSError, ValueError) as e:
+            if self.debug:
+                print("Failed to scan firmware file {}: {}".format(self.fw_file_path, e))
+        return markers
 
-        return str(out.decode()).strip()
+
+    @staticmethod
+    def _scan_fw_markers_in(mm, size, markers):
+        # Consecutive blocks overlap, so that a marker across a block boundary is found
+        overlap = max(len(m) for m in _FW_TYPE_MARKERS + _FW_ATF_VER_MARKERS) - 1
+        pos = 0
+        while pos < size:
+            start = max(0, pos - overlap)
+            end   = min(pos + FW_SCAN_CHUNK_SIZE, size)
+            chunk = mm[start:end]
+            lower = chunk.lower()
+            for marker in _FW_TYPE_MARKERS:
+                if not markers[marker] and marker in lower:
+                    markers[marker] = True
+            if markers['atf_ver'] is None:
+                hits = [i for i in (chunk.find(m) for m in _FW_ATF_VER_MARKERS) if i >= 0]
+                if hits:
+                    # The whole printable string around the marker, as printed by "strings"
+                    first = last = start + min(hits)
+                    while first > 0 and mm[first - 1] in _PRINTABLE_BYTES:
+                        first -= 1
+                    while last < size and mm[last] in _PRINTABLE_BYTES:
+                        last += 1
+                    markers['atf_ver'] = mm[first:last].decode().strip()
+            if markers['atf_ver'] is not None and all(markers[m] for m in _FW_TYPE_MARKERS):
+                break
+            pos = end
+
+
+    def extract_atf_uefi_ver_from_fw_file(self):
+        atf_ver = self._scan_fw_file_markers()['atf_ver']
+        if atf_ver is None:
+            raise Err_Exception(Err_Num.FAILED_TO_GET_VER_FROM_FILE, 'No ATF/UEFI version found in {}'.format(self.fw_file_path))
+        return atf_ver
 
 
     def is_fw_file_for_bmc(self):
-        command  = 'strings {} | grep -i apfw'.format(self.fw_file_path)
-        process  = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = process.communicate()
-        if process.returncode != 0:
-            return False
-        return True
+        return self._scan_fw_file_markers()[b'apfw']
 
 
     def is_fw_file_for_cec(self):
-        command  = 'strings {} | grep -i ecfw'.format(self.fw_file_path)
-        process  = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = process.communicate()
-        if process.returncode != 0:
-            return False
-        return True
+        return self._scan_fw_file_markers()[b'ecfw']
 
 
     def is_fw_file_for_atf_uefi(self):
-        try:
-            self.extract_atf_uefi_ver_from_fw_file()
-        except:
-            return False
-        return True
+        return self._scan_fw_file_markers()['atf_ver'] is not None
 
 
     def is_fw_file_for_conf(self):
-        if not self.is_fw_file_for_atf_uefi():
-            return False
-        command  = 'strings {} | grep -i toutiao'.format(self.fw_file_path)
-        process  = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = process.communicate()
-        if process.returncode != 0:
-            return False
-        return True
+        # Same scan as the ATF/UEFI check, found in the scan cache once done
+        markers = self._scan_fw_file_markers()
+        return markers['atf_ver'] is not None and markers[b'toutiao']
 
 
     # return True:  task completed successfully
     # return False: task cancelled for skip_same_version
     def _wait_task(self, task_handle, max_second=15*60, check_step=10, err_handler=None):
-        # Check the task status within a loop
-        for i in range(1, max_second//check_step + 1):
+        # Check the task status within a loop. Poll faster when the task is about
+        # to complete, and slower when its percent has not moved for a while
+        deadline     = time.monotonic() + max_second
+        last_percent = None
+        stall_count  = 0
+        while True:
             task_state = self._get_task_status(task_handle)
             if task_state['state'] != "Running":
                 break
-            self._print_process(task_state['percent'])
-            time.sleep(check_step)
+            percent = task_state['percent']
+            self._print_process(percent)
+            stall_count  = stall_count + 1 if percent == last_percent else 0
+            last_percent = percent
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if isinstance(percent, int) and percent > 90:
+                sleep_for = min(2, check_step)
+            elif stall_count > 3:
+                sleep_for = check_step * 2
+            else:
+                sleep_for = check_step
+            time.sleep(min(sleep_for, remaining))
+        self.flush_log()
 
         # Check the task is completed successfully
         if task_state['state'] == 'Completed' and task_state['status'] == 'OK' and task_state['percent'] == 100:
@@ -1090,8 +1497,7 @@ class BF_DPU_Update(object):
 
     def is_bmc_background_copy_in_progress(self):
         url = self._get_url_base() + '/Chassis/Bluefield_ERoT'
-        response = self._http_get(url)
-        self.log('Get ERoT status', response)
+        response = self._http_get_conditional(url, 'Get ERoT status')
         self._handle_status_code(response, [200])
 
         '''
@@ -1110,8 +1516,8 @@ class BF_DPU_Update(object):
         '''
         status = ''
         try:
-            status = response.json()['Oem']['Nvidia']['BackgroundCopyStatus']
-        except Exception as e:
+            status = self._get_conditional_json(url, response)['Oem']['Nvidia']['BackgroundCopyStatus']
+        except _RESPONSE_FORMAT_ERRORS:
             raise Err_Exception(Err_Num.BAD_RESPONSE_FORMAT, 'Failed to extract BackgroundCopyStatus')
 
         if status != 'Completed':
@@ -1168,19 +1574,16 @@ class BF_DPU_Update(object):
 
         try:
             return response.json()['BmcRShim']['BmcRShimEnabled']
-        except:
+        except _RESPONSE_FORMAT_ERRORS:
             raise Err_Exception(Err_Num.BAD_RESPONSE_FORMAT, 'Failed to extract BmcRShimEnabled')
 
 
     def enable_rshim_on_bmc(self, enable):
         url = self._get_url_base() + '/Managers/Bluefield_BMC/Oem/Nvidia'
-        headers = {
-            'Content-Type' : 'application/json'
-        }
         data = {
             "BmcRShim": { "BmcRShimEnabled": enable }
         }
-        response = self._http_patch(url, json.dumps(data), headers=headers)
+        response = self._http_patch(url, json_data=data)
         self.log('{} rshim on BMC'.format("Enable" if enable else "Disable"), response)
         self._handle_status_code(response, [200])
 
@@ -1212,10 +1615,10 @@ class BF_DPU_Update(object):
     def _wait_for_bios_ready(self):
         print('Wait for BIOS ready')
         timeout = 60 * 3 # Wait up to 3 minutes
-        start   = int(time.time())
+        start   = time.monotonic()
         end     = start + timeout
         while True:
-            cur = int(time.time())
+            cur = time.monotonic()
             if cur > end:
                 self._print_process(100)
                 break
@@ -1230,9 +1633,22 @@ class BF_DPU_Update(object):
 
 
     def get_local_user_ssh_pub_key(self):
-        command = 'ssh-keyscan {}'.format(self._get_local_ip())
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = process.communicate()
+        # The host keys do not change during the run, scan them once per local address
+        local_ip = self._get_local_ip()
+        with _local_pub_keys_lock:
+            if local_ip not in _local_pub_keys:
+                _local_pub_keys[local_ip] = self._scan_local_ssh_pub_key(local_ip)
+            return list(_local_pub_keys[local_ip])
+
+
+    def _scan_local_ssh_pub_key(self, local_ip):
+        command = 'ssh-keyscan {}'.format(local_ip)
+        # No shell in between, ssh-keyscan is run directly
+        try:
+            process = subprocess.Popen(['ssh-keyscan', local_ip], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            raise Err_Exception(Err_Num.FAILED_TO_GET_LOCAL_KEY, 'Command "{}" failed: {}'.format(command, e))
+        out, _ = process.communicate()
         if process.returncode != 0:
             raise Err_Exception(Err_Num.FAILED_TO_GET_LOCAL_KEY, 'Command "{}" failed with return code {}'.format(command, process.returncode))
 
@@ -1240,30 +1656,24 @@ class BF_DPU_Update(object):
         127.0.0.1 ecdsa-sha2-nistp256 AAAAE2VjZHNhLXNoYTItbmlzdHAyNTYAAAAIbmlzdHAyNTYAAABBBLxvoG8lUk0CyiQ2Jk9IlTlrESlRtLzyIhQnPsXe5//YWl5nHa6oTSbkIlwk090tchoUi9nwFtTDE5Lihs1qJEc=
         127.0.0.1 ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIPzhBRfJL2pZ6LNikFnlBg7iqYXh7BDbQpfg9f1R7nch
         '''
-        try:
-            key_list = out.decode().split('\n')
-            ret_list = []
-            for key in key_list:
-                if key.strip() == '':
-                    continue
-                ret_list.append(' '.join(key.split(' ')[1:]))
-            if len(ret_list) == 0:
-                raise Err_Exception(Err_Num.FAILED_TO_GET_LOCAL_KEY)
-            return ret_list
-        except:
+        ret_list = []
+        for line in out.decode().splitlines():
+            # Drop the host name, keep "<type> <key>"
+            _, _, key = line.strip().partition(' ')
+            if key:
+                ret_list.append(key)
+        if len(ret_list) == 0:
             raise Err_Exception(Err_Num.FAILED_TO_GET_LOCAL_KEY, 'There may be no ssh-key locally (for user {}). Please run ssh-keygen firstly'.format(self._get_local_user()))
+        return ret_list
 
 
     def exchange_ssh_key_with_bmc(self, local_key):
         url = self._get_url_base() + "/UpdateService/Actions/Oem/NvidiaUpdateService.PublicKeyExchange"
-        headers = {
-            'Content-Type' : 'application/json'
-        }
         msg = {
           "RemoteServerIP"        : self._get_local_ip(),
           "RemoteServerKeyString" : local_key,
         }
-        response = self._http_post(url, data=json.dumps(msg), headers=headers)
+        response = self._http_post(url, json_data=msg)
         self.log('Exchange SSH key with BMC', response)
         self._handle_status_code(response, [200])
 
@@ -1288,36 +1698,41 @@ class BF_DPU_Update(object):
         '''
         try:
             return response.json()['@Message.ExtendedInfo'][0]['MessageArgs'][0]
-        except:
+        except _RESPONSE_FORMAT_ERRORS:
             raise Err_Exception(Err_Num.BAD_RESPONSE_FORMAT, 'Failed to extract BMC SSH key')
 
 
     def is_bmc_key_in_local_authorized_keys(self, bmc_key):
         file_path = os.path.expanduser("~") + '/.ssh/authorized_keys'
-        process = subprocess.Popen('grep "{}" {}'.format(bmc_key, file_path), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = process.communicate()
-        if process.returncode != 0:
+        try:
+            with open(file_path, 'r') as f:
+                return bmc_key in f.read()
+        except OSError:
             return False
-        return True
 
 
     def set_bmc_key_into_local_authorized_keys(self, bmc_key):
         file_path = os.path.expanduser("~") + '/.ssh/authorized_keys'
 
-        # Check and set write permission for ~/.ssh/authorized_keys
+        # Check and set write permission for ~/.ssh/authorized_keys; a missing
+        # file (and ~/.ssh) is created below, private to the user as sshd expects
         old_permission = None
-        if not os.access(file_path, os.W_OK):
+        if not os.path.exists(file_path):
+            os.makedirs(os.path.dirname(file_path), mode=0o700, exist_ok=True)
+        elif not os.access(file_path, os.W_OK):
             old_permission = os.stat(file_path).st_mode
             os.chmod(file_path, old_permission | stat.S_IWUSR)
 
-        # Append the bmc key into authorized_keys
-        with open(file_path, 'a') as f:
-            f.write(bmc_key + '\n')
+        # Append the bmc key into authorized_keys, in one unbuffered write
+        fd = os.open(file_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, (bmc_key + '\n').encode())
+        finally:
+            os.close(fd)
 
         # Recover the permission
         if old_permission is not None:
             os.chmod(file_path, old_permission)
-            old_permission = os.stat(file_path).st_mode
 
 
     def confirm_ssh_key_with_bmc(self):
@@ -1370,16 +1785,15 @@ class BF_DPU_Update(object):
     def get_dpu_boot_state(self):
         try:
             url = self._get_url_base() + '/Systems/Bluefield'
-            response = self._http_get(url)
-            self.log('Get DPU(ARM) boot state', response)
+            response = self._http_get_conditional(url, 'Get DPU(ARM) boot state')
             self._handle_status_code(response, [200])
         except Exception as e:
             return ''
 
         state = ''
         try:
-            state = response.json()['BootProgress']['OemLastState']
-        except Exception as e:
+            state = self._get_conditional_json(url, response)['BootProgress']['OemLastState']
+        except _RESPONSE_FORMAT_ERRORS:
             # Retry in case BMC reboot is in progress
             if self.debug:
                 print("BMC is rebooting.")
@@ -1412,10 +1826,10 @@ class BF_DPU_Update(object):
     def _wait_for_dpu_ready(self):
         print('Waiting for the BFB installation to finish')
         timeout = 60 * 40 # Wait up to 40 minutes
-        start   = int(time.time())
+        start   = time.monotonic()
         end     = start + timeout
         while True:
-            cur = int(time.time())
+            cur = time.monotonic()
             if cur > end:
                 self._print_process(100)
                 break
@@ -1432,13 +1846,10 @@ class BF_DPU_Update(object):
     def enable_runtime_rshim(self):
         self.log("Enable runtime rshim")
         url = self._get_url_base() + '/Systems/Bluefield/Oem/Nvidia/Actions/LFWP.Set'
-        headers = {
-            'Content-Type' : 'application/json'
-        }
         data = {
             'LFWP' : 'Enabled'
         }
-        response = self._http_post(url, data=json.dumps(data), headers=headers)
+        response = self._http_post(url, json_data=data)
         self.log('Enable runtime rshim', response)
         self._handle_status_code(response, [200])
 
@@ -1446,13 +1857,10 @@ class BF_DPU_Update(object):
     def disable_runtime_rshim(self):
         self.log("Disable runtime rshim")
         url = self._get_url_base() + '/Systems/Bluefield/Oem/Nvidia/Actions/LFWP.Set'
-        headers = {
-            'Content-Type' : 'application/json'
-        }
         data = {
             'LFWP' : 'Disabled'
         }
-        response = self._http_post(url, data=json.dumps(data), headers=headers)
+        response = self._http_post(url, json_data=data)
         self.log('Disable runtime rshim', response)
         self._handle_status_code(response, [200])
 
@@ -1466,7 +1874,8 @@ class BF_DPU_Update(object):
             self._handle_status_code(response, [200])
 
             # Check if Actions/LFWP.Set exists in the response
-            if 'Actions' in response.json() and '#LFWP.Set' in response.json()['Actions']:
+            actions = response.json().get('Actions', {})
+            if '#LFWP.Set' in actions:
                 return True
             return False
         except Exception as e:
@@ -1494,6 +1903,7 @@ class BF_DPU_Update(object):
         if not self.try_enable_rshim_on_bmc():
             raise Err_Exception(Err_Num.FAILED_TO_ENABLE_BMC_RSHIM, 'Please make sure rshim on Host side is disabled')
 
+        self.ensure_ssh_mux()
         self._set_bmc_rshim_display_level(2)
 
         if self.lfwp:
@@ -1520,11 +1930,13 @@ class BF_DPU_Update(object):
 
         if self.lfwp:
             print('Waiting for NIC Firmware to be updated and mlxfwreset to be done')
+            # The rshim misc polls below all go through the one SSH master connection
+            self.ensure_ssh_mux()
             misc = self.get_bmc_rshim_misc()
-            start = int(time.time())
+            start = time.monotonic()
             end = start + 30*60
             while 'Runtime upgrade finished' not in misc:
-                cur = int(time.time())
+                cur = time.monotonic()
                 if cur > end:
                     self.log('NIC Firmware update timeout')
                     break
@@ -1551,6 +1963,7 @@ class BF_DPU_Update(object):
 
     def send_reset_bios(self):
         print("Factory reset BIOS configuration (ResetBios) (will reboot the system)")
+        self._forget_bmc_available()
         url = self._get_url_base() + '/Systems/Bluefield/Bios/Actions/Bios.ResetBios'
         headers = {
             'Content-Type' : 'application/json'
@@ -1567,15 +1980,12 @@ class BF_DPU_Update(object):
     def send_reset_efi_vars(self):
         print("Factory reset EFI Var configuration (ResetEfiVars) (will reboot the system)")
         url = self._get_url_base() + '/Systems/Bluefield/Bios/Settings'
-        headers = {
-            'Content-Type' : 'application/json'
-        }
         data = {
             'Attributes': {
                 'ResetEfiVars': True,
             },
         }
-        response = self._http_patch(url, data=json.dumps(data), headers=headers)
+        response = self._http_patch(url, json_data=data)
         self.log('Factory reset EFI Var (ResetEfiVars)', response)
         self._handle_status_code(response, [200])
         self.reboot_system()
@@ -1584,13 +1994,7 @@ class BF_DPU_Update(object):
 
     def reboot_system(self):
         url = self._get_url_base() + '/Systems/Bluefield/Actions/ComputerSystem.Reset'
-        headers = {
-            'Content-Type' : 'application/json'
-        }
-        data = {
-            'ResetType': 'GracefulRestart'
-        }
-        response = self._http_post(url, data=json.dumps(data), headers=headers)
+        response = self._http_post(url, data=self._RESET_GRACEFUL_BODY, headers=self._JSON_HEADERS)
         self.log('Reboot DPU system', response)
         self._handle_status_code(response, [200, 204])
 
@@ -1598,16 +2002,15 @@ class BF_DPU_Update(object):
     def get_system_power_state(self):
         try:
             url = self._get_url_base() + '/Systems/Bluefield'
-            response = self._http_get(url)
-            self.log('Get System State', response)
+            response = self._http_get_conditional(url, 'Get System State')
             self._handle_status_code(response, [200])
         except Exception as e:
             return ''
 
         state = ''
         try:
-            state = response.json()['PowerState']
-        except Exception as e:
+            state = self._get_conditional_json(url, response)['PowerState']
+        except _RESPONSE_FORMAT_ERRORS:
             raise Err_Exception(Err_Num.BAD_RESPONSE_FORMAT, 'Failed to extract system power state')
         return state
 
@@ -1615,10 +2018,10 @@ class BF_DPU_Update(object):
     def _wait_for_system_power_on(self):
         pre_state = self.get_system_power_state()
         timeout = 60 * 3 # Wait up to 3 minutes
-        start   = int(time.time())
+        start   = time.monotonic()
         end     = start + timeout
         while True:
-            cur = int(time.time())
+            cur = time.monotonic()
             if cur > end:
                 self._print_process(100)
                 break
@@ -1666,10 +2069,9 @@ class BF_DPU_Update(object):
 
         # Construct the URL for the HTTP PUT request
         url = self._get_url_base() + '/Systems/Bluefield/Oem/Nvidia'
-        headers = {'Content-Type': 'application/json'}
 
         # Send the HTTP PUT request to update the OEM FRU data
-        response = self._http_put(url, data=json.dumps(oem_fru_dict), headers=headers)
+        response = self._http_put(url, json_data=oem_fru_dict)
         self.log('Update OEM FRU data', response)
         if response.status_code != 200:
             raise Err_Exception(Err_Num.INVALID_STATUS_CODE, "Failed to update OEM FRU data, status code: {}".format(response.status_code))
@@ -1685,7 +2087,11 @@ class BF_DPU_Update(object):
             elif protocol == "HTTP" and "Check and restart server's web service" in task_state['message']:
                 raise Err_Exception(Err_Num.HTTP_FILE_SERVER_NOT_ACCESSIBLE, "Server address: {}:{}".format(self._format_ip(self._get_local_ip()), self._local_http_server_port))
 
-        self._wait_task(task_handle, max_second=20*60, check_step=2, err_handler=err_handler)
+        try:
+            self._wait_task(task_handle, max_second=20*60, check_step=2, err_handler=err_handler)
+        finally:
+            # BMC has pulled the file once the task is over
+            self.stop_http_server()
 
 
     def update_conf(self):
@@ -1716,7 +2122,7 @@ class BF_DPU_Update(object):
 
     def wait_for_background_copy(self, timeout_minutes=20):
         """
-        Wait for BMC background copy operation to complete.
+        Wait for BMC background copy operation to complete, if one is in progress.
 
         Args:
             timeout_minutes (int): Maximum time to wait in minutes (default 20)
@@ -1727,82 +2133,83 @@ class BF_DPU_Update(object):
         Raises:
             Err_Exception: If background copy doesn't complete within timeout
         """
+        if not self.is_bmc_background_copy_in_progress():
+            return
+
         print("Waiting for BMC background copy to complete...")
         timeout = 60 * timeout_minutes  # Convert minutes to seconds
-        start = int(time.time())
+        start = time.monotonic()
         end = start + timeout
+        # Check soon after the start (the copy may be about to finish), then less often
+        backoff = _backoff_iter(initial=1, cap=30)
 
         while True:
-            cur = int(time.time())
+            cur = time.monotonic()
             if cur > end:
                 raise Err_Exception(Err_Num.BMC_BACKGROUND_BUSY,
                                   'BMC background copy operation did not complete within {} minutes'.format(timeout_minutes))
 
+            # Show progress
+            self._print_process(100 * (cur - start) / timeout)
+            time.sleep(max(0, min(next(backoff), end - time.monotonic())))
+
             if not self.is_bmc_background_copy_in_progress():
                 print("BMC background copy completed")
                 self._print_process(100)
                 print()
                 return
 
-            # Show progress
-            self._print_process(100 * (cur - start) / timeout)
-            time.sleep(10)  # Check every 10 seconds
-
 
     def do_update(self):
         # Check BMC availability before starting any operations
         self.check_bmc_availability()
 
-        if self.is_bmc_background_copy_in_progress():
-            # Wait for background copy to complete before proceeding
-            self.wait_for_background_copy()
-
-        # Wait for a random time to avoid race condition
-        time.sleep(random.randint(10, 30))
-
-        try:
-            last_task_info = self.get_last_task_info()
-        except Exception as e:
-            if self.debug:
-                print("Error getting last task info: {}".format(e))
-            last_task_info = None
+        # Wait for background copy (if any) to complete before proceeding
+        self.wait_for_background_copy()
 
+        # Nothing to wait for unless a task is running; otherwise wait for it, then
+        # back off a random time, so that instances waiting on the same task do not
+        # start their updates together
+        last_task_info = self._get_last_task_info_or_none()
         if last_task_info and last_task_info['state'] == 'Running':
             print("Waiting for last task to finish:\n    Id:        {}\n    TargetUri: {}".format(last_task_info['id'], last_task_info['payload']['TargetUri']))
             self.log('Last task info: {}'.format(last_task_info))
             if last_task_info['payload']['TargetUri'] == '/redfish/v1/UpdateService/Actions/UpdateService.SimpleUpdate':
-                self.log('SimpleUpdate task detected, waiting for 20 minutes')
-                time.sleep(20*60)
-            self._wait_task(last_task_info['id'], max_second=20*60, check_step=2, err_handler=None)
+                # A BFB install may run long: poll it (less often) for up to 40 minutes,
+                # as long as the former fixed 20 minutes wait plus the task wait
+                self.log('SimpleUpdate task detected, waiting for up to 40 minutes')
+                self._wait_task(last_task_info['id'], max_second=40*60, check_step=5, err_handler=None)
+            else:
+                self._wait_task(last_task_info['id'], max_second=20*60, check_step=2, err_handler=None)
             time.sleep(random.randint(10, 30))
             last_task_info = self.get_last_task_info()
             if last_task_info and last_task_info['state'] == 'Running':
                 raise Err_Exception(Err_Num.BMC_BACKGROUND_BUSY, 'Please try to update the {} later'.format(self.module))
 
-        if self.module == 'BMC' or self.module == "CEC":
-            self.update_bmc_or_cec((self.module == 'BMC'))
-        elif self.module == 'BIOS':
-            self.update_bios()
-        elif self.module == 'FRU':
-            self.update_oem_fru()
-        elif self.module == 'CONFIG':
-            self.update_conf()
-        elif self.module == 'BUNDLE':
-            self.update_bundle()
-        else:
+        update = self._UPDATE_DISPATCH.get(self.module)
+        if update is None:
             raise Err_Exception(Err_Num.UNSUPPORTED_MODULE, "Unsupported module: {}".format(self.module))
+        try:
+            update(self)
+        finally:
+            # Most updates (BMC, CEC, BUNDLE, CONFIG, ...) end with BMC restarted, or
+            # about to be: do not trust the last availability check afterwards
+            self._forget_bmc_available()
+            self.flush_log()
 
 
     def reset_config(self):
         self.validate_arg_for_reset_config()
         # Check BMC availability before proceeding
         self.check_bmc_availability()
-        if self.module == 'BMC':
-            self.factory_reset_bmc()
-        elif self.module == 'BIOS':
-            self.send_reset_bios()
-        else:
+        reset = self._RESET_CONFIG_DISPATCH.get(self.module)
+        if reset is None:
             raise Err_Exception(Err_Num.UNSUPPORTED_MODULE, "Unsupported module to reset config: {}".format(self.module))
+        try:
+            reset(self)
+        finally:
+            self._forget_bmc_available()
+            self.flush_log()
 
 
     def _get_firmware_uri_list(self):
@@ -1811,14 +2218,12 @@ class BF_DPU_Update(object):
         self.log('Get firmware URI list', response)
         self._handle_status_code(response, [200])
 
-        uri_list = []
+        # The collection only lists links ({"@odata.id": ...}), it is small enough
+        # to be parsed at once; the URIs are taken in one pass over it
         try:
-            members = response.json()['Members']
-            for member in members:
-                uri_list.append(member['@odata.id'])
-        except Exception as e:
+            return [member['@odata.id'] for member in response.json()['Members']]
+        except _RESPONSE_FORMAT_ERRORS:
             raise Err_Exception(Err_Num.BAD_RESPONSE_FORMAT, 'Failed to extract firmware URI list')
-        return uri_list
 
 
     def _get_firmware_uri_by_resource(self, resource):
@@ -1826,20 +2231,48 @@ class BF_DPU_Update(object):
 
 
     def _get_firmware_module_from_uri(self, uri):
-        for module, resource in self.module_resource.items():
-            if uri == self._get_firmware_uri_by_resource(resource):
-                return module
-        return uri.split('/')[-1]
+        module = self.uri_module.get(uri)
+        return module if module is not None else uri.rpartition('/')[2]
 
 
     def _get_all_versions_internal(self):
         """Internal method to get all versions without BMC availability check"""
+        if self._supports_inventory_expand is not False:
+            self._supports_inventory_expand, vers = self._get_all_versions_expanded()
+            if self._supports_inventory_expand:
+                return vers
+
         uri_list = self._get_firmware_uri_list()
-        vers = {}
-        for uri in uri_list:
-            module = self._get_firmware_module_from_uri(uri)
-            vers[module] = self.get_ver_by_uri(uri)
-        return vers
+        if not uri_list:
+            return {}
+        # The entries are independent, read them in parallel (map keeps the order)
+        with ThreadPoolExecutor(max_workers=min(MAX_VERSION_QUERIES, len(uri_list))) as executor:
+            versions = list(executor.map(self.get_ver_by_uri, uri_list))
+        return {self._get_firmware_module_from_uri(uri): ver for uri, ver in zip(uri_list, versions)}
+
+
+    def _get_all_versions_expanded(self):
+        '''
+        Get the versions of all firmware inventory members in one request.
+        Return (whether BMC expanded the members, versions or None); whether
+        is None when there is no member to tell
+        '''
+        url = self._get_url_base() + '/UpdateService/FirmwareInventory' + self._EXPAND_MEMBERS_QUERY
+        response = self._http_get(url)
+        self.log('Get expanded firmware inventory', response)
+        if response.status_code != 200:
+            return False, None
+
+        try:
+            members = response.json()['Members']
+            if not members:
+                return None, None
+            # The query is ignored by BMC without $expand support
+            if len(members[0]) == 1:
+                return False, None
+            return True, {self._get_firmware_module_from_uri(member['@odata.id']): member['Version'] for member in members}
+        except _RESPONSE_FORMAT_ERRORS:
+            raise Err_Exception(Err_Num.BAD_RESPONSE_FORMAT, 'Failed to extract firmware versions')
 
 
     def get_all_versions(self):
@@ -1857,32 +2290,26 @@ class BF_DPU_Update(object):
         if not self.info_data:
             return 'NA'
 
-        # Map module names to info_data keys
-        info_module = {
-            'ATF': 'BF3_ATF',
-            'UEFI': 'BF3_UEFI',
-            'BMC': 'BF3_BMC_FW',
-            'CEC': 'BF3_CEC_FW',
-            'NIC': 'BF3_NIC_FW'
-        }
-
-        for member in self.info_data["Members"]:
-            if member["Name"] == info_module[module]:
-                if member["Name"] == "BF3_BMC_FW":
-                    member["Version"] = "BF-" + member["Version"]
-                elif member["Name"] == "BF3_CEC_FW":
-                    member["Version"] = member["Version"] + "_n02"
-                elif member["Name"] == "BF3_ATF":
-                    member["Version"] = self.extract_atf_uefi_ver_from_fw_file()
-                return member["Version"]
-        return 'NA'
+        member = self._info_by_name.get(self._INFO_MODULE.get(module))
+        if member is None:
+            return 'NA'
+        # Shape the version as BMC reports it; info_data itself is left as read
+        ver = member["Version"]
+        if member["Name"] == "BF3_BMC_FW":
+            ver = "BF-" + ver
+        elif member["Name"] == "BF3_CEC_FW":
+            ver = ver + "_n02"
+        elif member["Name"] == "BF3_ATF":
+            ver = self.extract_atf_uefi_ver_from_fw_file()
+        return ver
 
     def show_old_new_versions(self, old_vers, new_vers, filter = []):
+        modules = [module for module in old_vers if len(filter) == 0 or module in filter]
+        # Look the BFB versions up first, a failing lookup does not leave half a table
+        info_vers = {module: self.get_info_data_version(module) for module in modules}
         print("%10s   %40s  %40s  %40s"%('', 'OLD Version', 'NEW Version', 'BFB Version'))
-        for module, ver in old_vers.items():
-            if len(filter) == 0 or module in filter:
-                info_ver = self.get_info_data_version(module)
-                print("%10s : %40s  %40s  %40s"%(module, ver, new_vers.get(module, ''), info_ver))
+        for module in modules:
+            print("%10s : %40s  %40s  %40s"%(module, old_vers[module], new_vers.get(module, ''), info_vers[module]))
 
 
     def show_all_versions(self):
@@ -1893,6 +2320,10 @@ class BF_DPU_Update(object):
 
     def set_info_data(self, info_data):
         self.info_data = info_data
+        # The first member of a name wins, as in a scan of the list
+        self._info_by_name = {}
+        for member in info_data["Members"]:
+            self._info_by_name.setdefault(member.get("Name"), member)
 
     def get_last_task_id(self):
         """
@@ -1918,7 +2349,7 @@ class BF_DPU_Update(object):
 
             # Get the last task ID from the list
             last_task = tasks[-1]['@odata.id']
-            last_task_id = last_task.split('/')[-1]
+            last_task_id = last_task.rpartition('/')[2]
             return last_task_id
 
         except Exception as e:
@@ -1939,6 +2370,11 @@ class BF_DPU_Update(object):
         Raises:
             Err_Exception: If no tasks found or unable to get task info
         """
+        if self._supports_task_expand is not False:
+            self._supports_task_expand, task_state = self._get_last_task_info_expanded()
+            if self._supports_task_expand:
+                return task_state
+
         task_id = self.get_last_task_id()
         if not task_id:
             return None
@@ -1950,3 +2386,39 @@ class BF_DPU_Update(object):
         # Add task ID to the returned info
         task_state['id'] = task_uri
         return task_state
+
+
+    def _get_last_task_info_or_none(self):
+        try:
+            return self.get_last_task_info()
+        except Exception as e:
+            if self.debug:
+                print("Error getting last task info: {}".format(e))
+            return None
+
+
+    def _get_last_task_info_expanded(self):
+        '''
+        Get the last task within the task list, in one request.
+        Return (whether BMC expanded the members, task info or None); whether
+        is None when there is no member to tell
+        '''
+        url = self._get_url_base() + '/TaskService/Tasks' + self._EXPAND_MEMBERS_QUERY
+        response = self._http_get(url)
+        self.log('Get Expanded Task List', response)
+        if response.status_code != 200:
+            return False, None
+
+        try:
+            tasks = response.json().get('Members', [])
+            if not tasks:
+                return None, None
+            last_task = tasks[-1]
+            # The query is ignored by BMC without $expand support
+            if 'TaskState' not in last_task:
+                return False, None
+            task_state = self._parse_task_state(last_task)
+            task_state['id'] = last_task['@odata.id']
+            return True, task_state
+        except _RESPONSE_FORMAT_ERRORS:
+            raise Err_Exception(Err_Num.BAD_RESPONSE_FORMAT, 'Failed to extract last task info')
@@ -6,9 +6,18 @@
 import time
 import os
 import json
+import shlex
 import subprocess
+import threading
 from error_num import *
 
+# orjson parses the Redfish responses faster when it is installed, it is optional.
+# Its decode error derives from ValueError, as the one of json does
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
 
 class CURL_Request(object):
     def __init__(self, url, method, command):
@@ -33,11 +42,16 @@ class CURL_Response(object):
 
 
     def json(self):
-        return json.loads(self.text)
+        return _json_loads(self.text)
+
+
+def create_session():
+    # Every curl command is a separate process, there is no connection to share
+    return None
 
 
 class HTTP_Accessor(object):
-    def __init__(self, url, method, username, password, task_dir, headers, timeout=(60, 60)):
+    def __init__(self, url, method, username, password, task_dir, headers, timeout=(60, 60), session=None):
         self.url = url
         self.method = method
         self.username = username
@@ -47,7 +61,11 @@ class HTTP_Accessor(object):
         self.task_dir = task_dir
 
 
-    def access(self, data=None):
+    def access(self, data=None, json_data=None):
+        if json_data is not None:
+            data = json.dumps(json_data)
+            self.headers = dict(self.headers or {})
+            self.headers.setdefault('Content-Type', 'application/json')
         return self._http_access(data=data)
 
 
@@ -79,20 +97,23 @@ class HTTP_Accessor(object):
 
 
     def _http_access(self, data=None, forms=None, transfer=None):
+        # The command goes through a shell: quote the values, so that e.g. the
+        # double quotes of an ETag (If-None-Match) reach BMC
         header_param = ''
         if self.headers is not None:
             for k in self.headers:
-                header_param += '-H "{}: {}" '.format(k, self.headers[k])
+                header_param += '-H {} '.format(shlex.quote('{}: {}'.format(k, self.headers[k])))
 
         ts = str(time.time())
         pid = os.getpid()
-        resp_body_file    = os.path.join(self.task_dir, 'dpu_update_resp_body_{}_{}.txt'.format(ts, pid))
-        resp_headers_file = os.path.join(self.task_dir, 'dpu_update_resp_headers_{}_{}.txt'.format(ts, pid))
+        tid = threading.get_ident()
+        resp_body_file    = os.path.join(self.task_dir, 'dpu_update_resp_body_{}_{}_{}.txt'.format(ts, pid, tid))
+        resp_headers_file = os.path.join(self.task_dir, 'dpu_update_resp_headers_{}_{}_{}.txt'.format(ts, pid, tid))
 
         output_param  = '-D {} -o {}'.format(resp_headers_file, resp_body_file)
         auth_param    = "-u '{}':'{}'".format(self.username, self.password)
         x_param       = '' if self.method == 'GET' else '-X {}'.format(self.method)
-        d_param       = '' if data is None else "-d '{}'".format(data)
+        d_param       = '' if data is None else '-d {}'.format(shlex.quote(data))
         T_param       = '' if transfer is None else '-T {}'.format(transfer)
         form_param    = '' if forms is None else forms
         timeout_param = '--max-time {} --connect-timeout {}'.format(self.timeout[0], self.timeout[1])
@@ -9,33 +9,116 @@ or install from local packages:
 python3 -m pip install --no-index --find-links=./packages requests
 """
 
+import os
+import binascii
 from error_num import *
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 import requests.packages.urllib3.util.ssl_
 requests.packages.urllib3.util.ssl_.DEFAULT_CIPHERS = 'ALL'
 
 
+# Connection pool of the shared session: one BMC host per session, a few
+# connections for the requests of the update and of the background checks
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE     = 16
+
+# Transient gateway errors of BMC web server, retried in the connection pool for
+# the idempotent methods only (urllib3 default: GET, PUT, DELETE, HEAD, ...)
+RETRY_STATUS_LIST  = (502, 503, 504)
+RETRY_TOTAL        = 3
+RETRY_BACKOFF      = 0.3
+
+
+def create_session():
+    session = requests.Session()
+    # Connection errors are still left to the callers, which know when BMC is
+    # rebooting; the last response is returned when the status retries run out
+    retry = Retry(total=RETRY_TOTAL, connect=0, read=0, status=RETRY_TOTAL,
+                  backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUS_LIST,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Size of the blocks a multipart body reads its files in
+MULTIPART_BLOCK_SIZE = 1 << 20
+
+
+class MultipartBody(object):
+    '''
+    multipart/form-data body sent block by block: the files are read from disk
+    while the body is sent, instead of the whole body being built in memory.
+    The length is known ahead, so the request keeps a Content-Length header.
+    '''
+    def __init__(self, multi_part_general_param):
+        self.boundary = binascii.hexlify(os.urandom(16)).decode()
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+        # Items are bytes, or the path of a file to send
+        self._parts = []
+        for k in multi_part_general_param:
+            v = multi_part_general_param[k]
+            head = '--{}\r\nContent-Disposition: form-data; name="{}"'.format(self.boundary, k)
+            content_type = v['type']
+            if v['is_file_path']:
+                head += '; filename="{}"'.format(os.path.basename(v['data']))
+                content_type = content_type or 'application/octet-stream'
+            if content_type:
+                head += '\r\nContent-Type: {}'.format(content_type)
+            self._parts.append((head + '\r\n\r\n').encode())
+            if v['is_file_path']:
+                self._parts.append(v['data'])
+            else:
+                self._parts.append(v['data'].encode() if isinstance(v['data'], str) else v['data'])
+            self._parts.append(b'\r\n')
+        self._parts.append('--{}--\r\n'.format(self.boundary).encode())
+
+
+    def __len__(self):
+        return sum(len(part) if isinstance(part, bytes) else os.path.getsize(part) for part in self._parts)
+
+
+    def __iter__(self):
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            with open(part, 'rb') as f:
+                while True:
+                    block = f.read(MULTIPART_BLOCK_SIZE)
+                    if not block:
+                        break
+                    yield block
+
+
 class HTTP_Accessor(object):
-    def __init__(self, url, method, username, password, headers, timeout=(60, 60)):
+    def __init__(self, url, method, username, password, task_dir, headers, timeout=(60, 60), session=None):
         self.url = url
         self.method = method
         self.username = username
         self.password = password
         self.headers = headers
         self.timeout = timeout
+        self.task_dir = task_dir
+        # Send the request through the shared session (keep-alive) if given
+        self.requester = session if session is not None else requests
 
 
-    def access(self, data=None):
+    def access(self, data=None, json_data=None):
+        # json_data is serialized by requests, which also sets the JSON Content-Type
         if self.method == 'GET':
             return self._http_get()
         elif self.method == 'POST':
-            return self._http_post(data=data)
+            return self._http_post(data=data, json_data=json_data)
         elif self.method == 'PATCH':
-            return self._http_patch(data=data)
+            return self._http_patch(data=data, json_data=json_data)
         elif self.method == 'PUT':
-            return self._http_put(data=data)
+            return self._http_put(data=data, json_data=json_data)
 
 
     def multi_part_push(self, multi_part_general_param):
@@ -50,15 +133,17 @@ class HTTP_Accessor(object):
          ...
         }
         '''
-        files = {}
-        for k in multi_part_general_param:
-            v = multi_part_general_param[k]
-            files[k] = open(v['data'], 'rb') if v['is_file_path'] else v['data']
-        return self._http_post(files=files)
+        body = MultipartBody(multi_part_general_param)
+        self.headers = dict(self.headers or {})
+        self.headers['Content-Type'] = body.content_type
+        return self._http_post(data=body)
 
 
     def upload_file(self, file_name):
-        return self._http_post(data=open(file_name, 'rb'))
+        # Pass the file object as body: requests streams it from disk block by block,
+        # so memory usage does not depend on the firmware size
+        with open(file_name, 'rb') as f:
+            return self._http_post(data=f)
 
 
     def connection_exception(func):
@@ -76,7 +161,7 @@ class HTTP_Accessor(object):
 
     @connection_exception
     def _http_get(self):
-        return requests.get(self.url,
+        return self.requester.get(self.url,
                             headers=self.headers,
                             auth=(self.username, self.password),
                             verify=False,
@@ -84,10 +169,11 @@ class HTTP_Accessor(object):
 
 
     @connection_exception
-    def _http_post(self, data=None, files=None):
-        return requests.post(self.url,
+    def _http_post(self, data=None, files=None, json_data=None):
+        return self.requester.post(self.url,
                              data=data,
                              files=files,
+                             json=json_data,
                              headers=self.headers,
                              auth=(self.username, self.password),
                              verify=False,
@@ -95,18 +181,20 @@ class HTTP_Accessor(object):
 
 
     @connection_exception
-    def _http_patch(self, data):
-        return requests.patch(self.url,
+    def _http_patch(self, data=None, json_data=None):
+        return self.requester.patch(self.url,
                               data=data,
+                              json=json_data,
                               headers=self.headers,
                               auth=(self.username, self.password),
                               verify=False,
                               timeout=self.timeout)
 
     @connection_exception
-    def _http_put(self, data):
-        return requests.put(self.url,
+    def _http_put(self, data=None, json_data=None):
+        return self.requester.put(self.url,
                               data=data,
+                              json=json_data,
                               headers=self.headers,
                               auth=(self.username, self.password),
                               verify=False,
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import http_accessor_curl
+
+
+# Stands for curl: saves its arguments, and answers with an empty 304 response
+FAKE_CURL = '''#!{python}
+import json, sys
+args = sys.argv[1:]
+with open({argv_file!r}, 'w') as f:
+    json.dump(args, f)
+open(args[args.index('-D') + 1], 'w').write('HTTP/1.1 304 Not Modified\\r\\n\\r\\n')
+open(args[args.index('-o') + 1], 'w').close()
+'''
+
+
+class CurlCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.argv_file = os.path.join(self.tmp.name, 'argv.json')
+        curl = os.path.join(self.tmp.name, 'curl')
+        with open(curl, 'w') as f:
+            f.write(FAKE_CURL.format(python=sys.executable, argv_file=self.argv_file))
+        os.chmod(curl, 0o755)
+        self.old_path = os.environ['PATH']
+        os.environ['PATH'] = self.tmp.name + os.pathsep + self.old_path
+
+
+    def tearDown(self):
+        os.environ['PATH'] = self.old_path
+        self.tmp.cleanup()
+
+
+    def _curl_argv(self, method, headers, **kwargs):
+        accessor = http_accessor_curl.HTTP_Accessor('https://127.0.0.1/redfish/v1/Systems/Bluefield', method,
+                                                    'user', 'pass', self.tmp.name, headers)
+        response = accessor.access(**kwargs)
+        with open(self.argv_file) as f:
+            return response, json.load(f)
+
+
+    def test_etag_header_keeps_quotes(self):
+        response, argv = self._curl_argv('GET', {'If-None-Match': '"1718a-5f3c"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(argv[argv.index('-H') + 1], 'If-None-Match: "1718a-5f3c"')
+
+
+    def test_json_body_is_sent_as_is(self):
+        _, argv = self._curl_argv('POST', None, json_data={'Name': "it's \"quoted\""})
+        self.assertEqual(json.loads(argv[argv.index('-d') + 1]), {'Name': "it's \"quoted\""})
+        self.assertEqual(argv[argv.index('-H') + 1], 'Content-Type: application/json')
+
+
+if __name__ == '__main__':
+    unittest.main()